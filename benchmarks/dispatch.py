@@ -0,0 +1,64 @@
+"""
+cost per message of finding the processor of a command line and parsing
+its arguments, with the linear predicate scan re-tokenizing the line in
+every step versus the dispatch table and a line parsed once.
+
+    python -m benchmarks.dispatch --messages 100000
+"""
+import argparse
+import time
+
+from js import commands
+from js import parsers
+from js.samples import command_samples
+
+LINES = [sample.replace('!js', '', 1).strip() for sample in command_samples] \
+    + ['kbsw-16 50x5', 'pullup 10,8,8', 'squat-60 5x5', 'burpee 20']
+
+
+def _parse_func(processor):
+    if processor is commands._workout_processor:
+        return parsers.parse_command_with_records
+    return parsers.parse_command_with_text_arguments
+
+
+def linear_dispatch(text):
+    cmd = text.split()[0]
+    for processor in commands.cmd_processors:
+        if processor.is_triggered(cmd):
+            break
+    else:
+        # not an operation name, so it is a workout name
+        processor = commands._workout_processor
+    return processor, _parse_func(processor)(text)
+
+
+def table_dispatch(text):
+    line = parsers.parse_command_line(text)
+    _, processor = commands.find_processor(line)
+    return processor, _parse_func(processor)(line)
+
+
+def per_message(dispatch, messages):
+    lines = [LINES[i % len(LINES)] for i in range(messages)]
+    started = time.perf_counter()
+    for line in lines:
+        dispatch(line)
+    return (time.perf_counter() - started) / messages * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    for line in LINES:
+        assert linear_dispatch(line) == table_dispatch(line), line
+    linear = per_message(linear_dispatch, args.messages)
+    table = per_message(table_dispatch, args.messages)
+    print(f'linear predicate scan: {linear:.2f}us/message')
+    print(f'dispatch table:        {table:.2f}us/message ({linear / table:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
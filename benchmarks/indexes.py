@@ -0,0 +1,146 @@
+"""
+latency of the hot record and progress queries without and with the
+secondary indexes, on a synthetic sqlite database.
+
+    python -m benchmarks.indexes --users 200 --records 2000000
+"""
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+import flask
+from sqlalchemy import desc
+
+from js import models as m
+
+INDEXES = [
+    index
+    for table in m.db.metadata.sorted_tables
+    for index in table.indexes
+]
+
+
+def create_app(uri, sqlite_pragmas=None):
+    app = flask.Flask("js-bench")
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if sqlite_pragmas is not None:
+        # read by `init_app` when it creates the engine
+        app.config['SQLITE_PRAGMAS'] = sqlite_pragmas
+    m.init_app(app)
+    return app
+
+
+def populate(users, records, seed=0):
+    rnd = random.Random(seed)
+    m.db.create_all()
+    m.Workout.create_builtin_workouts()
+    m.Challenge.create_builtin_challenges()
+    engine = m.db.engine
+    workout_ids = [w.id for w in m.Workout.query.all()]
+    challenge_ids = [c.id for c in m.Challenge.query.all()]
+    engine.execute(m.User.__table__.insert(),
+                   [{'id': i, 'name': f'user{i}', 'invisible': False}
+                    for i in range(1, users + 1)])
+
+    start = datetime.datetime.utcnow() - datetime.timedelta(days=365)
+    step = datetime.timedelta(days=365) / records
+    batch = []
+    for i in range(records):
+        times = rnd.randint(5, 50)
+        batch.append({'ts': start + step * i, 'times': times, 'sets': str(times),
+                      'workout_id': rnd.choice(workout_ids),
+                      'user_id': rnd.randint(1, users)})
+        if len(batch) == 10000:
+            engine.execute(m.WorkOutRecord.__table__.insert(), batch)
+            batch = []
+    if batch:
+        engine.execute(m.WorkOutRecord.__table__.insert(), batch)
+
+    engine.execute(m.ChallengeProgress.__table__.insert(), [
+        {'user_id': user_id, 'challenge_id': challenge_id, 'achieved': 0,
+         'start_record_id': rnd.randint(0, records),
+         'latest_record_id': 0, 'finished': rnd.random() < .5}
+        for user_id in range(1, users + 1)
+        for challenge_id in challenge_ids
+    ])
+    engine.execute(m.Command.__table__.insert(), [
+        {'user_id': rnd.randint(1, users), 'text': 'kbsw-16 50x5',
+         'ts': start + step * i * 10}
+        for i in range(records // 10)
+    ])
+
+
+def queries(users, records):
+    rnd = random.Random(1)
+    days_ago = datetime.datetime.utcnow() - datetime.timedelta(days=3)
+    challenge_ids = [c.id for c in m.Challenge.query.all()]
+
+    def show():
+        m.WorkOutRecord.query.filter_by(user_id=rnd.randint(1, users)) \
+            .filter(m.WorkOutRecord.ts > days_ago) \
+            .order_by(desc(m.WorkOutRecord.ts)).limit(1000).all()
+
+    def recalculate_scan():
+        m.WorkOutRecord.query.filter_by(user_id=rnd.randint(1, users)) \
+            .filter(m.WorkOutRecord.id > records // 2) \
+            .order_by(m.WorkOutRecord.id).all()
+
+    def joined_progress():
+        m.ChallengeProgress.query \
+            .filter_by(user_id=rnd.randint(1, users),
+                       challenge_id=rnd.choice(challenge_ids),
+                       finished=False).first()
+
+    def badges():
+        m.ChallengeProgress.query \
+            .filter_by(user_id=rnd.randint(1, users), finished=True).count()
+
+    def recent_commands():
+        m.Command.query.filter_by(user_id=rnd.randint(1, users)) \
+            .filter(m.Command.ts > days_ago).all()
+
+    return [show, recalculate_scan, joined_progress, badges, recent_commands]
+
+
+def timeit(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--records', type=int, default=500000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app('sqlite:///' + os.path.join(tmp, 'bench.db'))
+        with app.app_context():
+            print(f'populating {args.records} records of {args.users} users ...')
+            populate(args.users, args.records)
+            funcs = queries(args.users, args.records)
+
+            for index in INDEXES:
+                index.drop(m.db.engine)
+            m.db.engine.execute('ANALYZE')
+            before = [timeit(f, args.repeat) for f in funcs]
+
+            for index in INDEXES:
+                index.create(m.db.engine)
+            m.db.engine.execute('ANALYZE')
+            after = [timeit(f, args.repeat) for f in funcs]
+
+    print(f'{"query":<20}{"before(ms)":>12}{"after(ms)":>12}{"speedup":>10}')
+    for func, b, a in zip(funcs, before, after):
+        print(f'{func.__name__:<20}{b:>12.3f}{a:>12.3f}{b / a:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+end to end load test of the bearychat and telegram endpoints over http,
+with the telegram replies delivered to a local stub of the bot api.
+
+    python -m benchmarks.load --requests 2000 --concurrency 16
+    python -m benchmarks.load --mix checkin=1 --channel telegram
+"""
+import argparse
+import collections
+import concurrent.futures
+import copy
+import importlib
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+from js.outbound import _StubApi
+from js.samples import beary_request_sample, telegram_request_sample
+
+# command texts of each command type, all with arguments since telegram
+# ignores bot commands without one
+COMMANDS = {
+    'checkin': ['kbsw-16 5x50', 'kbsw-24 50', 'kbsw-12 50,40,40,40,40', 'pullup 15'],
+    'show': ['show 3', 'show 7', 'show 30'],
+    'challenge': ['challenge show', 'challenge list'],
+    'list': ['list all'],
+}
+DEFAULT_MIX = 'checkin=6,show=2,challenge=1,list=1'
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in COMMANDS:
+            raise argparse.ArgumentTypeError(f'unknown command type: {kind}')
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def beary_payload(user, command):
+    payload = dict(beary_request_sample)
+    payload['user_name'] = user
+    payload['text'] = f'{payload["trigger_word"]} {command}'
+    return payload
+
+
+def telegram_payload(user_id, message_id, command):
+    payload = copy.deepcopy(telegram_request_sample)
+    message = payload['message']
+    message['message_id'] = message_id
+    message['from']['id'] = message['chat']['id'] = user_id
+    message['text'] = '/' + command.replace('-', '_', 1)
+    message['entities'][0]['length'] = len(message['text'].split()[0])
+    return payload
+
+
+def build_requests(args):
+    rnd = random.Random(args.seed)
+    kinds, weights = zip(*args.mix.items())
+    channels = ['beary', 'telegram'] if args.channel == 'both' else [args.channel]
+    result = []
+    for i in range(args.requests):
+        kind = rnd.choices(kinds, weights)[0]
+        command = rnd.choice(COMMANDS[kind])
+        user = rnd.randrange(args.users)
+        if rnd.choice(channels) == 'beary':
+            result.append((kind, '/js', beary_payload(f'user{user}', command)))
+        else:
+            result.append((kind, '/bot/token',
+                           telegram_payload(1000000 + user, i, command)))
+    return result
+
+
+def serve(users):
+    """
+    import the app with the environment set up by `main`, create its
+    database and serve it in a background thread.
+    """
+    main = importlib.import_module('js.main')
+    m = importlib.import_module('js.models')
+    with main.app.app_context():
+        m.db.create_all()
+        m.Workout.create_builtin_workouts()
+        m.Challenge.create_builtin_challenges()
+        # users of both channels exist up front, concurrent first check-ins
+        # of one telegram user would otherwise race to create it
+        for i in range(users):
+            m.get_or_create_user(f'user{i}')
+            m.get_or_create_user(str(1000000 + i))
+        m.db.session.commit()
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return main, server
+
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'weights of the command types, default {DEFAULT_MIX}')
+    parser.add_argument('--channel', choices=['beary', 'telegram', 'both'], default='both')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    api = _StubApi()
+    tmp = tempfile.TemporaryDirectory()
+    os.environ['JS_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp.name, 'load.db')
+    os.environ['JS_TELEGRAM_API_URL'] = api.url
+    os.environ.setdefault('JS_COMMAND_LOG', 'db')
+    app_module, server = serve(args.users)
+    url = f'http://127.0.0.1:{server.server_port}'
+    local = threading.local()
+
+    def send(item):
+        kind, path, payload = item
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            ok = local.session.post(url + path, json=payload, timeout=30).ok
+        except requests.RequestException:
+            ok = False
+        return kind, time.perf_counter() - started, ok
+
+    work = build_requests(args)
+    print(f'sending {len(work)} requests with concurrency {args.concurrency} ...')
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(send, work))
+    elapsed = time.perf_counter() - started
+    app_module.get_sender().stop()
+    server.shutdown()
+    api.close()
+
+    by_kind = collections.defaultdict(list)
+    errors = collections.Counter()
+    for kind, latency, ok in results:
+        by_kind[kind].append(latency)
+        errors[kind] += not ok
+    print(f'{"command":<12}{"count":>8}{"req/s":>10}{"errors":>8}'
+          f'{"p50(ms)":>10}{"p95(ms)":>10}{"p99(ms)":>10}')
+    for kind, latencies in sorted(by_kind.items()):
+        latencies.sort()
+        print(f'{kind:<12}{len(latencies):>8}{len(latencies) / elapsed:>10.1f}'
+              f'{errors[kind]:>8}{percentile(latencies, .5):>10.2f}'
+              f'{percentile(latencies, .95):>10.2f}{percentile(latencies, .99):>10.2f}')
+    print(f'total {len(results) / elapsed:.1f} req/s in {elapsed:.2f}s, '
+          f'{len(api.calls)} telegram replies delivered to the stub api')
+    tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+microbenchmarks of the parser, dispatch and challenge hot paths on an
+in-memory sqlite fixture, saved as json and compared with a baseline.
+
+    python -m benchmarks.micro --save baseline.json
+    python -m benchmarks.micro --users 200 --records 50000 --compare baseline.json
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+from js import challenges as ch
+from js import commands
+from js import models as m
+from js import parsers
+from .dispatch import LINES
+from .indexes import create_app, populate
+
+
+def bench_parse_records():
+    texts = ['50', '50x5', '50,40x4', '20,20,15,15,10']
+    i = 0
+
+    def run():
+        nonlocal i
+        parsers.parse_records(texts[i % len(texts)])
+        i += 1
+    return run
+
+
+def bench_find_processor():
+    lines = [parsers.parse_command_line(line) for line in LINES]
+    i = 0
+
+    def run():
+        nonlocal i
+        commands.find_processor(lines[i % len(lines)])
+        i += 1
+    return run
+
+
+def bench_find_def():
+    challenges = m.Challenge.query.all()
+    i = 0
+
+    def run():
+        nonlocal i
+        ch.ChallengeDef.find_def(challenges[i % len(challenges)])
+        i += 1
+    return run
+
+
+def bench_update_challenge_progress():
+    rnd = random.Random(0)
+    users = m.User.query.all()
+
+    def run():
+        user = rnd.choice(users)
+        records, _ = m.add_record(user, rnd.choice(['kbsw-16', 'pullup', 'burpee']),
+                                  [(rnd.randint(5, 50), 3)])
+        ch.update_challenge_progress_for_user(user, records)
+    return run
+
+
+def bench_recalculate_challenge_progress():
+    rnd = random.Random(0)
+    users = m.User.query.all()
+
+    def run():
+        ch.recalculate_challenge_progress_for_user(rnd.choice(users))
+    return run
+
+
+BENCHMARKS = [
+    # name, factory, calls per round
+    ('parse_records', bench_parse_records, 20000),
+    ('find_processor', bench_find_processor, 20000),
+    ('find_def', bench_find_def, 20000),
+    ('update_challenge_progress', bench_update_challenge_progress, 200),
+    ('recalculate_challenge_progress', bench_recalculate_challenge_progress, 20),
+]
+
+
+def measure(run, number, rounds):
+    """
+    the best time of `rounds` rounds of `number` calls, in microseconds
+    per call. changes made to the fixture are rolled back after each round.
+    """
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(number):
+            run()
+        elapsed = (time.perf_counter() - started) / number * 1e6
+        m.db.session.rollback()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def compare(results, baseline, threshold):
+    """
+    print the results next to the baseline, return the names of the
+    benchmarks slower than `threshold` times their baseline.
+    """
+    regressions = []
+    print(f'{"benchmark":<32}{"us/call":>12}{"baseline":>12}{"ratio":>8}')
+    for name, value in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            print(f'{name:<32}{value:>12.2f}{"-":>12}{"-":>8}')
+            continue
+        ratio = value / base
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<32}{value:>12.2f}{base:>12.2f}{ratio:>7.2f}x{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--only', action='append', help='run only the named benchmarks')
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--compare', help='a json file of earlier results to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    app = create_app('sqlite://')
+    results = {
+        'users': args.users,
+        'records': args.records,
+        'python': platform.python_version(),
+        'benchmarks': {},
+    }
+    with app.app_context():
+        print(f'populating {args.records} records of {args.users} users ...')
+        populate(args.users, args.records)
+        for name, factory, number in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            results['benchmarks'][name] = measure(factory(), number, args.rounds)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline['users'], baseline['records']) != (args.users, args.records):
+            print('warning: the baseline was measured on a fixture of '
+                  f'{baseline["users"]} users and {baseline["records"]} records')
+        regressions = compare(results, baseline, args.threshold)
+    else:
+        regressions = []
+        for name, value in results['benchmarks'].items():
+            print(f'{name:<32}{value:>12.2f}us/call')
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressions:
+        print(f'{len(regressions)} regressions: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+cold start cost: importing the web app in a fresh interpreter, and seeding
+the builtin workouts and challenges into an empty and an already seeded
+sqlite database.
+
+    python -m benchmarks.startup --repeat 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event
+
+from js import models as m
+from .indexes import create_app
+
+IMPORT_SCRIPT = '''
+import sys, time
+started = time.perf_counter()
+import js.main
+print(time.perf_counter() - started, 'requests' in sys.modules)
+'''
+
+
+def time_import(repeat):
+    env = dict(os.environ)
+    times, loaded = [], False
+    with tempfile.TemporaryDirectory() as tmp:
+        env['JS_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp, 'js.db')
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT],
+                                             env=env, stderr=subprocess.DEVNULL)
+            elapsed, requests_loaded = output.decode().split()
+            times.append(float(elapsed))
+            loaded = loaded or requests_loaded == 'True'
+    return times, loaded
+
+
+def time_seed(repeat):
+    """
+    (ms, statements) of seeding an empty database and a seeded one.
+    """
+    empty, seeded = [], []
+    statements = {}
+    for _ in range(repeat):
+        app = create_app('sqlite://')
+        with app.app_context():
+            m.db.create_all()
+            engine = m.db.engine
+            for result in (empty, seeded):
+                count = [0]
+
+                def on_execute(*args):
+                    count[0] += 1
+                event.listen(engine, 'before_cursor_execute', on_execute)
+                started = time.perf_counter()
+                m.Workout.create_builtin_workouts()
+                m.Challenge.create_builtin_challenges()
+                result.append((time.perf_counter() - started) * 1000)
+                event.remove(engine, 'before_cursor_execute', on_execute)
+                statements[id(result)] = count[0]
+            m.db.session.remove()
+            engine.dispose()
+    return (statistics.median(empty), statements[id(empty)]), \
+        (statistics.median(seeded), statements[id(seeded)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    times, requests_loaded = time_import(args.repeat)
+    print(f'import js.main:  median {statistics.median(times) * 1000:.1f}ms, '
+          f'min {min(times) * 1000:.1f}ms, requests loaded: {requests_loaded}')
+    (empty, empty_statements), (seeded, seeded_statements) = time_seed(args.repeat)
+    print(f'seed empty db:   {empty:.2f}ms, {empty_statements} statements')
+    print(f'seed seeded db:  {seeded:.2f}ms, {seeded_statements} statements')
+
+
+if __name__ == '__main__':
+    main()
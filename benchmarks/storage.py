@@ -0,0 +1,129 @@
+"""
+throughput of concurrent worker processes checking in and reading records,
+with sqlite in rollback journal mode, sqlite in wal mode and optionally a
+pooled server database.
+
+    python -m benchmarks.storage --workers 8 --ops 200
+    python -m benchmarks.storage --uri postgresql://localhost/js_bench
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from js import models as m
+from js import challenges as ch
+from .indexes import create_app
+
+MODES = {
+    # the pragmas sqlite used before they were configurable
+    'sqlite-rollback': {'journal_mode': 'DELETE', 'synchronous': 'FULL',
+                        'busy_timeout': 5000, 'mmap_size': 0, 'cache_size': -2000},
+    'sqlite-wal': {},
+}
+
+
+def check_journal_mode(pragmas):
+    """
+    fail unless the connections use the journal mode of the benchmarked mode.
+    """
+    if m.db.engine.dialect.name != 'sqlite':
+        return
+    expected = dict(m.SQLITE_PRAGMAS, **pragmas)['journal_mode'].lower()
+    actual = m.db.session.execute('PRAGMA journal_mode').scalar().lower()
+    assert actual == expected, f'journal_mode is {actual}, expected {expected}'
+
+
+def prepare(uri, pragmas, users):
+    app = create_app(uri, pragmas)
+    with app.app_context():
+        check_journal_mode(pragmas)
+        m.db.drop_all()
+        m.db.create_all()
+        m.Workout.create_builtin_workouts()
+        m.Challenge.create_builtin_challenges()
+        for i in range(users):
+            user, _ = m.get_or_create_user(f'user{i}')
+            m.add_challenge_progress(user, 'kbsw-10000')
+        m.db.session.commit()
+    m.db.get_engine(app).dispose()
+
+
+def worker(uri, pragmas, users, ops, write_ratio, seed, results):
+    rnd = random.Random(seed)
+    app = create_app(uri, pragmas)
+    latencies, errors = [], 0
+    with app.app_context():
+        check_journal_mode(pragmas)
+        for _ in range(ops):
+            user = m.get_user(f'user{rnd.randrange(users)}')
+            started = time.perf_counter()
+            try:
+                if rnd.random() < write_ratio:
+                    records, _ = m.add_record(user, 'kbsw-16', [(rnd.randint(10, 50), 3)])
+                    ch.update_challenge_progress_for_user(user, records)
+                else:
+                    m.daily_rollup_summary(user, '2000-01-01')
+                    m.active_challenge_progresses(user)
+                m.db.session.commit()
+            except OperationalError:
+                m.db.session.rollback()
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+    m.db.get_engine(app).dispose()
+    results.put((latencies, errors))
+
+
+def run(uri, pragmas, args):
+    prepare(uri, pragmas, args.users)
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=worker, args=(
+            uri, pragmas, args.users, args.ops, args.write_ratio, seed, results))
+        for seed in range(args.workers)
+    ]
+    started = time.perf_counter()
+    for p in processes:
+        p.start()
+    collected = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency for worker, _ in collected for latency in worker)
+    errors = sum(e for _, e in collected)
+    return len(latencies) / elapsed, errors, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--ops', type=int, default=200, help='operations per worker')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--write-ratio', type=float, default=.5)
+    parser.add_argument('--uri', help='a server database to compare with, it is emptied')
+    args = parser.parse_args()
+
+    print(f'{"mode":<18}{"ops/s":>10}{"errors":>8}{"p50(ms)":>10}{"p95(ms)":>10}{"max(ms)":>10}')
+    with tempfile.TemporaryDirectory() as tmp:
+        modes = [(name, 'sqlite:///' + os.path.join(tmp, f'{name}.db'), pragmas)
+                 for name, pragmas in MODES.items()]
+        if args.uri:
+            modes.append(('server', args.uri, {}))
+        for name, uri, pragmas in modes:
+            throughput, errors, latencies = run(uri, pragmas, args)
+            if latencies:
+                p50 = latencies[len(latencies) // 2] * 1000
+                p95 = latencies[int(len(latencies) * .95)] * 1000
+                slowest = latencies[-1] * 1000
+            else:
+                p50 = p95 = slowest = float('nan')
+            print(f'{name:<18}{throughput:>10.1f}{errors:>8}{p50:>10.2f}{p95:>10.2f}{slowest:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+asyncio ingress for the chat webhooks.
+
+the requests are parsed and dispatched like in `main`, but the connections
+are held by an event loop: the database work runs on a bounded thread pool
+and the telegram replies are sent with non-blocking http calls.
+
+    python -m js.aio --port 8080
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import time
+
+import aiohttp
+from aiohttp import web
+
+from .main import app as flask_app
+from .main import handle_telegram, process_bearychat, run_committed
+from .outbound import _SenderBase
+
+
+class AsyncOutboundSender(_SenderBase):
+    """
+    deliver bot api method calls as tasks of the running event loop, the
+    asyncio counterpart of `outbound.OutboundSender`.
+    """
+
+    def __init__(self, api_url, concurrency=4, max_pending=1000, timeout=2.,
+                 max_retries=3, backoff=.5, breaker=None):
+        super().__init__(api_url, timeout, max_retries, backoff, breaker)
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.tasks = set()
+        self.session = None
+        self.semaphore = None
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def stop(self, timeout=5.):
+        """
+        wait for the pending calls to be delivered, then close the session.
+        """
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=timeout)
+        await self.session.close()
+
+    def submit(self, token, method, payload):
+        """
+        schedule a bot api call, return False if it is dropped.
+        """
+        if not self._admit(method):
+            return False
+        if len(self.tasks) >= self.max_pending:
+            self.stats.incr('dropped')
+            logging.warning('too many pending calls, drop %s call', method)
+            return False
+        task = asyncio.ensure_future(
+            self._deliver(token, method, payload, time.monotonic()))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    def _queue_depth(self):
+        return len(self.tasks)
+
+    def _is_retryable(self, error):
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status == 429 or error.status >= 500
+        return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    async def _deliver(self, token, method, payload, enqueued_at):
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                if not self._allow_attempt(method):
+                    return
+                try:
+                    async with self.session.post(self._url(token, method),
+                                                 json=payload) as response:
+                        response.raise_for_status()
+                except Exception as error:
+                    delay = self._failed(error, method, attempt)
+                    if delay is None:
+                        return
+                    await asyncio.sleep(delay)
+                else:
+                    self._succeeded(enqueued_at)
+                    return
+
+
+def _in_app_context(app, func, *args):
+    with app.app_context():
+        return func(*args)
+
+
+def create_aio_app(app=flask_app):
+    """
+    an aiohttp application serving the webhooks of the flask `app`, with its
+    configuration and database.
+    """
+    aio_app = web.Application()
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=app.config['AIO_DB_WORKERS'], thread_name_prefix='aio-db')
+    sender = AsyncOutboundSender(app.config['TELEGRAM_API_URL'],
+                                 concurrency=app.config['TELEGRAM_SENDER_WORKERS'],
+                                 max_pending=app.config['TELEGRAM_SENDER_QUEUE_SIZE'])
+
+    def run_db(func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(executor, _in_app_context, app, func, *args)
+
+    async def bearychat(request):
+        response = await run_db(run_committed, process_bearychat, await request.json())
+        return web.json_response(response)
+
+    async def telegram(request):
+        try:
+            reply, messages = await run_db(handle_telegram, await request.json())
+            if reply is not None:
+                return web.json_response(reply)
+            for message in messages:
+                sender.submit(request.match_info['token'], 'sendMessage', message)
+        except Exception:
+            logging.exception("get error")
+        return web.Response(text='ok')
+
+    async def outbound_stats(request):
+        return web.json_response(sender.report())
+
+    async def on_startup(aio_app):
+        await sender.start()
+
+    async def on_cleanup(aio_app):
+        await sender.stop()
+        executor.shutdown(wait=True)
+
+    aio_app.router.add_post('/js', bearychat)
+    aio_app.router.add_post('/bot/{token}', telegram)
+    aio_app.router.add_get('/stats/outbound', outbound_stats)
+    aio_app.on_startup.append(on_startup)
+    aio_app.on_cleanup.append(on_cleanup)
+    return aio_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='serve the chat webhooks with asyncio')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--backlog', type=int, default=1024)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_aio_app(), host=args.host, port=args.port, backlog=args.backlog)
+
+
+def test_aio_ingress():
+    import copy
+
+    from . import models as m
+    from .app import _create_app_with_env
+    from .outbound import _StubApi
+    from .samples import beary_request_sample, telegram_request_sample
+
+    api = _StubApi()
+    app = _create_app_with_env(JS_DATABASE_URI='sqlite://', JS_COMMAND_LOG='off',
+                               JS_TELEGRAM_API_URL=api.url, JS_AIO_DB_WORKERS='1')
+    with app.app_context():
+        m.db.create_all()
+        m.Workout.create_builtin_workouts()
+        m.get_or_create_user('your_name')
+        m.db.session.commit()
+    update = copy.deepcopy(telegram_request_sample)
+
+    async def run():
+        runner = web.AppRunner(create_aio_app(app))
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = 'http://127.0.0.1:%s' % runner.addresses[0][1]
+        try:
+            async with aiohttp.ClientSession() as session:
+                beary = dict(beary_request_sample, text='!js kbsw-16 50x2')
+                async with session.post(url + '/js', json=beary) as response:
+                    reply = await response.json()
+                async with session.post(url + '/bot/token', json=update) as response:
+                    ack = await response.text()
+        finally:
+            await runner.cleanup()
+        return reply, ack
+
+    loop = asyncio.new_event_loop()
+    try:
+        reply, ack = loop.run_until_complete(run())
+    finally:
+        loop.close()
+        api.close()
+    assert reply == {'text': '打卡:\n16公斤壶铃摆荡: 50x2'}
+    assert ack == 'ok'
+    assert [path for path, _ in api.calls] == ['/bottoken/sendMessage']
+    message = api.calls[0][1]
+    assert message['chat_id'] == update['message']['chat']['id']
+    assert message['text'] == '打卡:\n16公斤壶铃摆荡: 5x50'
+    with app.app_context():
+        assert m.WorkOutRecord.query.count() == 2
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,77 @@
+import os
+
 import flask
 
 from . import models
+from . import parsers
 
 
 def create_app():
     app = flask.Flask("js")
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///js.db'
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        os.environ.get('JS_DATABASE_URI', 'sqlite:///js.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # connection pool of a server database like postgresql://user@host/js,
+    # sqlite files are opened per checkout and tuned by `SQLITE_PRAGMAS`
+    for name in ('POOL_SIZE', 'MAX_OVERFLOW', 'POOL_TIMEOUT', 'POOL_RECYCLE'):
+        value = os.environ.get(f'JS_DB_{name}')
+        if value is not None:
+            app.config[f'SQLALCHEMY_{name}'] = int(value)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_pre_ping': os.environ.get('JS_DB_POOL_PRE_PING', '') in ('1', 'true', 'yes'),
+    }
+    # 'synchronous=FULL,mmap_size=0' overrides `models.SQLITE_PRAGMAS`
+    app.config['SQLITE_PRAGMAS'] = dict(
+        item.split('=', 1)
+        for item in os.environ.get('JS_SQLITE_PRAGMAS', '').split(',') if item)
+    # reply to telegram in the webhook response body instead of calling
+    # sendMessage, see https://core.telegram.org/bots/api#making-requests-when-getting-updates
+    app.config['TELEGRAM_WEBHOOK_REPLY'] = \
+        os.environ.get('JS_TELEGRAM_WEBHOOK_REPLY', '') in ('1', 'true', 'yes')
+    app.config['TELEGRAM_API_URL'] = \
+        os.environ.get('JS_TELEGRAM_API_URL', 'https://api.telegram.org')
+    app.config['TELEGRAM_SENDER_WORKERS'] = \
+        int(os.environ.get('JS_TELEGRAM_SENDER_WORKERS', '4'))
+    app.config['TELEGRAM_SENDER_QUEUE_SIZE'] = \
+        int(os.environ.get('JS_TELEGRAM_SENDER_QUEUE_SIZE', '1000'))
+    # long polling getUpdates instead of the webhook, see `poller`
+    app.config['TELEGRAM_TOKEN'] = os.environ.get('JS_TELEGRAM_TOKEN')
+    app.config['TELEGRAM_POLL_LIMIT'] = int(os.environ.get('JS_TELEGRAM_POLL_LIMIT', '100'))
+    app.config['TELEGRAM_POLL_TIMEOUT'] = int(os.environ.get('JS_TELEGRAM_POLL_TIMEOUT', '30'))
+    # threads running the database work of the asyncio ingress, see `aio`
+    app.config['AIO_DB_WORKERS'] = int(os.environ.get('JS_AIO_DB_WORKERS', '8'))
+    # upper bounds of a single check-in, see `parsers.parse_record_groups`
+    app.config['RECORD_MAX_SETS'] = \
+        int(os.environ.get('JS_RECORD_MAX_SETS', parsers.MAX_SETS))
+    app.config['RECORD_MAX_TIMES'] = \
+        int(os.environ.get('JS_RECORD_MAX_TIMES', parsers.MAX_TIMES))
+    # audit log of the received commands: 'db', 'jsonl' or 'off', see `cmdlog`
+    app.config['COMMAND_LOG'] = os.environ.get('JS_COMMAND_LOG', 'db')
+    app.config['COMMAND_LOG_PATH'] = \
+        os.environ.get('JS_COMMAND_LOG_PATH', 'commands.jsonl')
+    app.config['COMMAND_LOG_MAX_BYTES'] = \
+        int(os.environ.get('JS_COMMAND_LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+    app.config['COMMAND_LOG_BACKUPS'] = \
+        int(os.environ.get('JS_COMMAND_LOG_BACKUPS', '5'))
+    app.config['COMMAND_LOG_BATCH_SIZE'] = \
+        int(os.environ.get('JS_COMMAND_LOG_BATCH_SIZE', '100'))
+    app.config['COMMAND_LOG_INTERVAL'] = \
+        int(os.environ.get('JS_COMMAND_LOG_INTERVAL_MS', '200')) / 1000.
     models.init_app(app)
     return app
+
+
+def _create_app_with_env(**env):
+    """
+    `create_app` with the given environment variables, for the tests.
+    """
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        return create_app()
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name)
+            else:
+                os.environ[name] = value
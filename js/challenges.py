@@ -1,26 +1,80 @@
 from datetime import timedelta
+import itertools
 import logging
 
 from flask import g
-from sqlalchemy import asc
+from sqlalchemy import asc, func
 
 from . import models as m
 
-definitions = []
+
+class ChallengeRegistry:
+    """
+    challenge definitions indexed by (family, total) of the challenges they
+    are targeted for, and by the workouts triggering them.
+    """
+
+    def __init__(self):
+        self.definitions = []
+        self.by_key = {}
+        self.by_workout = {}
+
+    def extend(self, definitions):
+        for definition in definitions:
+            self.definitions.append(definition)
+            self.by_key[(definition.family, definition.total)] = definition
+        self.by_workout.clear()
+
+    def __iter__(self):
+        return iter(self.definitions)
+
+    def find(self, challenge):
+        return self.by_key.get((m.workout_family(challenge.name), challenge.total))
+
+    def triggered_by(self, workout_name):
+        """
+        definitions whose progresses are updated by records of the workout.
+        """
+        triggered = self.by_workout.get(workout_name)
+        if triggered is None:
+            triggered = frozenset(d for d in self.definitions
+                                  if d.triggers(workout_name))
+            self.by_workout[workout_name] = triggered
+        return triggered
+
+
+definitions = ChallengeRegistry()
 
 
 class ChallengeDef:
+    # challenges named '<family>-...' with the same total use this definition
+    family = None
+    total = None
+    # achieved is the sum of `record.times * weight(workout)` over triggered
+    # records, so recalculation can aggregate it in sql
+    additive = False
+
+    def weight(self, workout_name):
+        return 1
+
     def match_challenge(self, challenge):
         """
         is this definition targeted for the specified challenge object.
         """
-        return False
+        return m.workout_family(challenge.name) == self.family \
+            and challenge.total == self.total
+
+    def triggers(self, workout_name):
+        """
+        will records of the specified workout trigger a progress updating on this challenge.
+        """
+        raise NotImplementedError
 
     def is_triggered(self, record):
         """
         will the specified record trigger a progress updating on this challenge.
         """
-        raise NotImplementedError
+        return self in definitions.triggered_by(record.workout_name)
 
     def initial(self):
         """"
@@ -30,10 +84,24 @@ class ChallengeDef:
 
     def on_update(self, progress, record):
         """
-        update progress on new record.
+        update progress on new record, a check-in of `record.groups` run
+        length (times, count) sets adding up to `record.times`.
         """
         raise NotImplementedError
 
+    def on_update_records(self, progress, records):
+        """
+        update progress on new records in order, until it is finished.
+        """
+        updated = False
+        for record in records:
+            if progress.finished:
+                break
+            updated = self.on_update(progress, record) or updated
+            progress.latest_record_id = record.id
+            progress.latest_record_ts = record.ts
+        return updated
+
     def repr(self, progress):
         """
         human readble representation of a challenge progress
@@ -45,9 +113,7 @@ class ChallengeDef:
         """
         find definition for challenge object.
         """
-        for definition in definitions:
-            if definition.match_challenge(challenge):
-                return definition
+        return definitions.find(challenge)
 
 
 class KbswChallenge(ChallengeDef):
@@ -55,15 +121,14 @@ class KbswChallenge(ChallengeDef):
     壶铃摆荡挑战
     """
 
+    family = 'kbsw'
+    additive = True
+
     def __init__(self, total):
         self.total = total
 
-    def match_challenge(self, challenge):
-        return challenge.name.startswith('kbsw') \
-               and challenge.total == self.total
-
-    def is_triggered(self, record):
-        return record.workout.name.startswith('kbsw')
+    def triggers(self, workout_name):
+        return workout_name.startswith('kbsw')
 
     def initial(self):
         return {}
@@ -99,15 +164,14 @@ class PullUpChallenge(ChallengeDef):
     引体向上挑战
     """
 
+    family = 'pullup'
+    additive = True
+
     def __init__(self, total):
         self.total = total
 
-    def match_challenge(self, challenge):
-        return challenge.name.startswith('pullup') \
-               and challenge.total == self.total
-
-    def is_triggered(self, record):
-        return record.workout.name.startswith('pullup')
+    def triggers(self, workout_name):
+        return workout_name.startswith('pullup')
 
     def initial(self):
         return {}
@@ -145,15 +209,14 @@ class PbPressChallenge(ChallengeDef):
     双杠臂屈伸挑战
     """
 
+    family = 'pbpress'
+    additive = True
+
     def __init__(self, total):
         self.total = total
 
-    def match_challenge(self, challenge):
-        return challenge.name.startswith('pbpress') \
-               and challenge.total == self.total
-
-    def is_triggered(self, record):
-        return record.workout.name.startswith('pbpress')
+    def triggers(self, workout_name):
+        return workout_name.startswith('pbpress')
 
     def initial(self):
         return {}
@@ -191,15 +254,14 @@ class MuscleUpChallenge(ChallengeDef):
     双力臂挑战
     """
 
+    family = 'muscleup'
+    additive = True
+
     def __init__(self, total):
         self.total = total
 
-    def match_challenge(self, challenge):
-        return challenge.name.startswith('muscleup') \
-               and challenge.total == self.total
-
-    def is_triggered(self, record):
-        return record.workout.name.startswith('muscleup')
+    def triggers(self, workout_name):
+        return workout_name.startswith('muscleup')
 
     def initial(self):
         return {}
@@ -236,15 +298,13 @@ class SquatChanllenge(ChallengeDef):
     深蹲挑战
     """
 
+    family = 'squat'
+    additive = True
+
     def __init__(self, total):
         self.total = total * 1000
 
-    def match_challenge(self, challenge):
-        return challenge.name.startswith('squat') \
-               and challenge.total == self.total
-
-    def is_triggered(self, record):
-        workout_name = record.workout.name
+    def triggers(self, workout_name):
         parts = workout_name.split('-', 1)
         return len(parts) >= 2 \
             and parts[0] in ('squat', 'kbsq') \
@@ -253,12 +313,13 @@ class SquatChanllenge(ChallengeDef):
     def initial(self):
         return {}
 
+    def weight(self, workout_name):
+        return int(workout_name.split('-', 1)[1])
+
     def on_update(self, progress, record):
         if progress.achieved >= self.total:
             return False
-        parts = record.workout.name.split('-', 1)
-        kilo = int(parts[1]) * record.times
-        progress.achieved = progress.achieved + kilo
+        progress.achieved = progress.achieved + record.tonnage
         if progress.achieved >= self.total:
             progress.finished = True
         return True
@@ -287,14 +348,12 @@ class ContinuousWorkoutChallenge(ChallengeDef):
     连续打卡挑战
     """
 
+    family = 'workout'
+
     def __init__(self, total):
         self.total = total
 
-    def match_challenge(self, challenge):
-        return challenge.name.startswith('workout') \
-               and challenge.total == self.total
-
-    def is_triggered(self, record):
+    def triggers(self, workout_name):
         return True
 
     def initial(self):
@@ -303,18 +362,17 @@ class ContinuousWorkoutChallenge(ChallengeDef):
     def on_update(self, progress, record):
         if progress.achieved >= self.total:
             return False
-        latest_record = m.WorkOutRecord.query \
-            .filter_by(id=progress.latest_record_id).first()
-        if latest_record is None:
+        latest_ts = progress.latest_record_ts
+        if latest_ts is None:
             progress.achieved = 1
             return True
-        if latest_record.ts.date() == record.ts.date():
+        if latest_ts.date() == record.ts.date():
             # hotfix(initial challenge join)
             if progress.achieved == 0:
                 progress.achieved += 1
                 return True
             return False
-        delta = record.ts - latest_record.ts
+        delta = record.ts - latest_ts
         if delta < timedelta(days=2):
             progress.achieved += 1
             if progress.achieved >= self.total:
@@ -324,6 +382,16 @@ class ContinuousWorkoutChallenge(ChallengeDef):
         progress.achieved = 1
         return True
 
+    def on_update_records(self, progress, records):
+        # only the first record of a day can change the streak
+        firsts = [next(day_records) for _, day_records
+                  in itertools.groupby(records, lambda r: r.ts.date())]
+        updated = super().on_update_records(progress, firsts)
+        if not progress.finished:
+            progress.latest_record_id = records[-1].id
+            progress.latest_record_ts = records[-1].ts
+        return updated
+
     def repr(self, progress):
         achieved = progress.achieved
         total = progress.challenge.total
@@ -348,15 +416,14 @@ class BurpeeChallenge(ChallengeDef):
     burpee 挑战
     """
 
+    family = 'burpee'
+    additive = True
+
     def __init__(self, total):
         self.total = total
 
-    def match_challenge(self, challenge):
-        return challenge.name.startswith('burpee') \
-               and challenge.total == self.total
-
-    def is_triggered(self, record):
-        return record.workout.name == 'burpee'
+    def triggers(self, workout_name):
+        return workout_name == 'burpee'
 
     def initial(self):
         return {}
@@ -430,24 +497,35 @@ def join_challenge(challenge_name):
 
 
 def update_challenge_progress_for_user(user, records: list):
+    triggered = frozenset().union(*(definitions.triggered_by(name) for name in
+                                    {record.workout_name for record in records}))
     updated_progresses = []
-    for progress in user.challenges:
+    # progresses are already in the session, the flush only writes those
+    # the records actually changed
+    for progress in m.active_challenge_progresses(user):
         challenge = progress.challenge
         definition = ChallengeDef.find_def(challenge)
         if definition is None:
             logging.warn('no definition found for %s', challenge)
             continue
-        updated = False
-        for record in records:
-            updated = update_progress(user, progress, record, definition) \
-                      or updated
+        if definition not in triggered:
+            continue
+        updated = update_progress(user, progress, records, definition)
         if updated:
             updated_progresses.append(progress)
-        m.db.session.add(progress)
     return updated_progresses
 
 
 def recalculate_challenge_progress_for_user(user):
+    """
+    recalculate progresses of the user from their records after they started.
+
+    additive progresses are summed up in sql, the others (and additive ones
+    finished on the way) are fed with one ordered pass over the records.
+    """
+    workouts = m.workout_catalog().by_id
+    sums = {}
+    replayed = []
     for progress in user.challenges:
         challenge = progress.challenge
         definition = ChallengeDef.find_def(challenge)
@@ -457,32 +535,141 @@ def recalculate_challenge_progress_for_user(user):
         to_update = definition.initial()
         to_update['achieved'] = 0
         to_update['finished'] = False
-        start_record_id = progress.start_record_id
+        start_record_id = progress.start_record_id or 0
         to_update['latest_record_id'] = start_record_id
+        to_update['latest_record_ts'] = None
         for k, v in to_update.items():
             setattr(progress, k, v)
-        m.db.session.add(progress)
-        m.db.session.flush()
+        if definition.additive \
+                and _sum_progress(user, progress, definition, workouts, sums):
+            continue
+        replayed.append((progress, definition))
 
+    if len(replayed) != 0:
+        start_record_id = min(p.start_record_id or 0 for p, _ in replayed)
         records = m.WorkOutRecord.query \
             .with_parent(user) \
             .filter(m.WorkOutRecord.id > start_record_id) \
             .order_by(asc(m.WorkOutRecord.id))
-
         for record in records:
-            update_progress(user, progress, record, definition)
-        m.db.session.add(progress)
+            for progress, definition in replayed:
+                if record.id > (progress.start_record_id or 0):
+                    update_progress(user, progress, [record], definition)
+    user.set_finished_challenges(sum(1 for p in user.challenges if p.finished))
+
 
+def _sum_progress(user, progress, definition, workouts, sums):
+    """
+    set achieved of an additive progress from per workout sums of the records
+    after it started, return False if it would be finished by them, as the
+    record finishing it has to be found by replaying.
+    """
+    start_record_id = progress.start_record_id or 0
+    rows = sums.get(start_record_id)
+    if rows is None:
+        rows = m.db.session.query(m.WorkOutRecord.workout_id,
+                                  func.sum(m.WorkOutRecord.times),
+                                  func.max(m.WorkOutRecord.id),
+                                  func.max(m.WorkOutRecord.ts)) \
+            .filter(m.WorkOutRecord.user_id == user.id,
+                    m.WorkOutRecord.id > start_record_id) \
+            .group_by(m.WorkOutRecord.workout_id) \
+            .all()
+        sums[start_record_id] = rows
+    rows = [row for row in rows
+            if definition in definitions.triggered_by(workouts[row[0]].name)]
+    achieved = sum(definition.weight(workouts[workout_id].name) * times
+                   for workout_id, times, _, _ in rows)
+    if achieved >= definition.total:
+        return False
+    progress.achieved = achieved
+    if len(rows) != 0:
+        progress.latest_record_id = max(row[2] for row in rows)
+        progress.latest_record_ts = max(row[3] for row in rows)
+    return True
 
-def update_progress(user, progress, record, definition):
+
+def update_progress(user, progress, records, definition):
     if progress.finished:
         return False
-    if not definition.is_triggered(record):
+    records = [record for record in records if definition.is_triggered(record)]
+    if len(records) == 0:
         return False
     before_change = definition.repr(progress)
-    updated = definition.on_update(progress, record)
-    progress.latest_record_id = record.id
+    updated = definition.on_update_records(progress, records)
+    if progress.finished:
+        user.add_finished_challenge()
     after_change = definition.repr(progress)
     logging.info('update progress of %s from %s to %s with %s',
-                 user.name, before_change, after_change, record)
+                 user.name, before_change, after_change, records)
     return updated
+
+
+def test_challenge_registry():
+    kbsw = definitions.find(m.Challenge(name='kbsw-10000', total=10000))
+    assert isinstance(kbsw, KbswChallenge) and kbsw.total == 10000
+    assert kbsw.match_challenge(m.Challenge(name='kbsw-10000', total=10000))
+    squat = definitions.find(m.Challenge(name='squat-50', total=50 * 1000))
+    assert isinstance(squat, SquatChanllenge)
+    assert definitions.find(m.Challenge(name='kbsw-10000', total=1)) is None
+    assert definitions.find(m.Challenge(name='unknown-100', total=100)) is None
+
+    triggered = definitions.triggered_by('kbsq-16')
+    assert squat in triggered and kbsw not in triggered
+    assert all(isinstance(d, (SquatChanllenge, ContinuousWorkoutChallenge))
+               for d in triggered)
+    assert definitions.triggered_by('kbsq-16') is triggered
+    assert {type(d) for d in definitions.triggered_by('burpee')} == \
+        {BurpeeChallenge, ContinuousWorkoutChallenge}
+
+
+def test_continuous_workout_challenge():
+    from datetime import datetime
+
+    def record(record_id, day, hour=8):
+        return m.WorkOutRecord(id=record_id, times=10,
+                               ts=datetime(2019, 5, day, hour))
+
+    streak = ContinuousWorkoutChallenge(3)
+    progress = m.ChallengeProgress(achieved=0, finished=False)
+    assert streak.on_update_records(progress, [record(1, 1), record(2, 1)])
+    assert (progress.achieved, progress.latest_record_id) == (1, 2)
+    assert not streak.on_update_records(progress, [record(3, 1, 20)])
+    assert progress.achieved == 1
+
+    assert streak.on_update_records(progress, [record(4, 2), record(5, 4)])
+    assert progress.achieved == 1
+    assert progress.latest_record_ts == datetime(2019, 5, 4, 8)
+
+    streak.on_update_records(progress, [record(6, 5), record(7, 6), record(8, 7)])
+    assert progress.achieved == 3 and progress.finished
+    assert progress.latest_record_id == 7
+
+
+@m._with_db
+def test_recalculate_challenge_progress_for_user():
+    m.Workout.create_builtin_workouts()
+    m.Challenge.create_builtin_challenges()
+    user, _ = m.get_or_create_user('user')
+    m.add_record(user, 'kbsw-16', [(50, 1)])
+    names = ['kbsw-10000', 'pullup-500', 'squat-50', 'workout-30d', 'burpee-500']
+    for name in names:
+        m.add_challenge_progress(user, name)
+    for workout, groups in [('kbsw-16', [(50, 2)]), ('pullup', [(200, 2)]),
+                            ('kbsq-16', [(100, 1)]), ('pullup', [(150, 1)]),
+                            ('kbsw-24', [(30, 1)]), ('squat-60', [(5, 2)])]:
+        records, _ = m.add_record(user, workout, groups)
+        update_challenge_progress_for_user(user, records)
+    m.db.session.commit()
+    progresses = sorted(user.challenges, key=lambda p: p.id)
+    expected = [(p.achieved, p.finished, p.latest_record_id) for p in progresses]
+    assert expected == [(130, False, 6), (550, True, 5), (2200, False, 7),
+                        (1, False, 7), (0, False, 1)]
+
+    for p in progresses:
+        p.achieved, p.finished = 0, False
+    user.set_finished_challenges(0)
+    recalculate_challenge_progress_for_user(user)
+    assert [(p.achieved, p.finished, p.latest_record_id)
+            for p in progresses] == expected
+    assert user.finished_challenges == 1
@@ -0,0 +1,218 @@
+"""
+buffered audit log of the received commands.
+
+the request path only puts an entry into a bounded queue, a writer thread
+drains it in batches of up to `batch_size` entries or `interval` seconds
+into a sink: the `command` table with one executemany insert, or an
+append-only jsonl file rotated by size.
+"""
+import collections
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+
+class DatabaseSink:
+    def __init__(self, engine):
+        from .models import Command
+        self.engine = engine
+        self.table = Command.__table__
+        # a longer text fails the insert of the whole batch on backends
+        # enforcing the column length
+        self.max_text_length = Command.text.type.length
+
+    def write(self, entries):
+        with self.engine.begin() as conn:
+            conn.execute(self.table.insert(), entries)
+
+    def close(self):
+        pass
+
+
+class JsonlSink:
+    """
+    one json object per line, the file is rolled over to `path`.1 ...
+    `path`.`backup_count` once it reaches `max_bytes`.
+    """
+
+    max_text_length = None
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf8')
+
+    def write(self, entries):
+        for entry in entries:
+            line = json.dumps(dict(entry, ts=entry['ts'].isoformat()),
+                              ensure_ascii=False)
+            self.handler.emit(logging.makeLogRecord({'msg': line}))
+        self.handler.flush()
+
+    def close(self):
+        self.handler.close()
+
+
+class CommandLogWriter:
+    """
+    write command log entries to `sink` in a background thread.
+
+        writer = CommandLogWriter(DatabaseSink(engine))
+        writer.start()
+        writer.submit(user.id, 'kbsw-16 50x5')
+    """
+
+    def __init__(self, sink, batch_size=100, interval=.2, queue_size=10000):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True,
+                                           name='command-log')
+            self.thread.start()
+        return self
+
+    def stop(self, timeout=5.):
+        """
+        write the queued entries, then stop the writer thread.
+        """
+        if self.thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            logging.warning('command log queue full, stop without flushing')
+        self.thread.join(max(0, deadline - time.monotonic()))
+        if not self.thread.is_alive():
+            self.thread = None
+            self.sink.close()
+
+    def submit(self, user_id, text):
+        """
+        enqueue a command log entry, return False if it is dropped.
+        """
+        entry = {'user_id': user_id, 'text': text[:self.sink.max_text_length],
+                 'ts': datetime.datetime.utcnow()}
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self._incr('dropped')
+            logging.warning('command log queue full, drop entry of user %s', user_id)
+            return False
+        return True
+
+    def report(self):
+        with self.lock:
+            result = dict(self.counters)
+        for name in ('written', 'failed', 'dropped', 'batches'):
+            result.setdefault(name, 0)
+        result['queue_depth'] = self.queue.qsize()
+        return result
+
+    def _incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            entry = self.queue.get()
+            if entry is None:
+                return
+            batch = [entry]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self.queue.get(
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self.sink.write(batch)
+        except Exception:
+            self._incr('failed', len(batch))
+            logging.exception('failed to write %s command log entries', len(batch))
+        else:
+            self._incr('written', len(batch))
+            self._incr('batches')
+
+
+def create_command_log(app):
+    """
+    the command log writer configured by `COMMAND_LOG` of `app`:
+    'db', 'jsonl' or 'off'.
+    """
+    backend = app.config['COMMAND_LOG']
+    if backend == 'off':
+        return None
+    if backend == 'jsonl':
+        sink = JsonlSink(app.config['COMMAND_LOG_PATH'],
+                         max_bytes=app.config['COMMAND_LOG_MAX_BYTES'],
+                         backup_count=app.config['COMMAND_LOG_BACKUPS'])
+    elif backend == 'db':
+        from .models import db
+        sink = DatabaseSink(db.get_engine(app))
+    else:
+        raise ValueError(f'unknown command log backend: {backend}')
+    return CommandLogWriter(sink, batch_size=app.config['COMMAND_LOG_BATCH_SIZE'],
+                            interval=app.config['COMMAND_LOG_INTERVAL'])
+
+
+def test_database_sink_batches():
+    import os
+    import tempfile
+
+    import sqlalchemy
+    from .models import db
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(tmp, 'js.db'))
+        db.metadata.create_all(engine)
+        writer = CommandLogWriter(DatabaseSink(engine), batch_size=2, interval=1).start()
+        for i in range(4):
+            assert writer.submit(1, f'kbsw-16 {i}')
+        assert writer.submit(1, 'x' * 200)
+        writer.stop()
+        rows = engine.execute('select user_id, text from command order by id').fetchall()
+        engine.dispose()
+    assert rows == [(1, f'kbsw-16 {i}') for i in range(4)] + [(1, 'x' * 128)]
+    report = writer.report()
+    assert (report['written'], report['batches'], report['queue_depth']) == (5, 3, 0)
+
+
+def test_jsonl_sink_rotates():
+    import glob
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'commands.jsonl')
+        writer = CommandLogWriter(JsonlSink(path, max_bytes=200, backup_count=10),
+                                  interval=.01).start()
+        for i in range(10):
+            writer.submit(i, f'打卡 {i}')
+        writer.stop()
+        entries = []
+        for name in sorted(glob.glob(path + '*'), reverse=True):
+            with open(name, encoding='utf8') as f:
+                entries.extend(json.loads(line) for line in f)
+        assert len(glob.glob(path + '.*')) > 0
+    assert [(e['user_id'], e['text']) for e in entries] == \
+        [(i, f'打卡 {i}') for i in range(10)]
@@ -1,29 +1,28 @@
 from datetime import datetime, timedelta
-import itertools
 import logging
 import string
 
-from flask import g
-from sqlalchemy import desc
+from flask import current_app, g
 
-from .parsers import parse_command_with_records as pcr
+from .parsers import ParseError, format_groups, parse_command_line, split_command_lines
+from .parsers import MAX_SETS, MAX_TIMES, parse_command_with_record_groups
 from .parsers import parse_command_with_text_arguments as pct
 from . import models as m
 from . import challenges as ch
 
-cmd_processors = []
-
 
 class CmdRegisterItem:
     def __init__(self, func, help_msg="", predicate=None):
         self.func = func
         self.help_msg = help_msg
+        # commands triggered by an exact name are dispatched with a dict lookup
+        self.command_name = None
         if predicate is None:
             self.predicate = lambda cmd: cmd == func.__name__
-            self.name = func.__name__
+            self.name = self.command_name = func.__name__
         elif isinstance(predicate, str):
             self.predicate = lambda cmd: cmd == predicate
-            self.name = predicate
+            self.name = self.command_name = predicate
         else:
             self.predicate = predicate
             self.name = func.__name__
@@ -32,12 +31,44 @@ class CmdRegisterItem:
         return self.predicate(cmd)
 
     def process(self, cmd):
-        return self.func(cmd)
+        return self.func(parse_command_line(cmd))
+
+
+class CmdDispatcher:
+    """
+    registered command processors, looked up by name in a dict, then by the
+    custom predicates in registration order.
+    """
+
+    def __init__(self):
+        self.processors = []
+        self.by_name = {}
+        self.predicated = []
+
+    def register(self, item: CmdRegisterItem):
+        self.processors.append(item)
+        if item.command_name is not None:
+            self.by_name.setdefault(item.command_name, item)
+        else:
+            self.predicated.append(item)
+
+    def lookup(self, cmd: str):
+        processor = self.by_name.get(cmd)
+        if processor is not None:
+            return processor
+        for processor in self.predicated:
+            if processor.is_triggered(cmd):
+                return processor
+        return None
+
+
+dispatcher = CmdDispatcher()
+cmd_processors = dispatcher.processors
 
 
 def register_cmd(predicate=None, help_msg=''):
     def wrapper(f):
-        cmd_processors.append(CmdRegisterItem(f, help_msg, predicate))
+        dispatcher.register(CmdRegisterItem(f, help_msg, predicate))
         return f
     return wrapper
 
@@ -51,7 +82,11 @@ def parser(parse_func):
     def wrapper(func):
         @functools.wraps(func)
         def process_wrapped(cmdline):
-            return func(*parse_func(cmdline))
+            try:
+                args = parse_func(cmdline)
+            except ParseError as error:
+                return f'无法解析: {error.text}'
+            return func(*args)
         return process_wrapped
 
     return wrapper
@@ -97,12 +132,8 @@ def merge_description(workouts):
 @register_cmd('list', help_msg='列出所有支持的运动项目')
 @parser(pct)
 def list_workouts(cmd, _=None):
-    workouts = [w for w in m.Workout.query.all()]
-    workouts.sort(key=lambda w: w.name)
     names = []
-    for name, group in itertools.groupby(workouts,
-                                         lambda w: w.name.split('-', 1)[0]):
-        group_workouts = [w for w in group]
+    for name, group_workouts in m.workout_catalog().families:
         if len(group_workouts) == 1:
             names.append(f'{group_workouts[0].name}: {group_workouts[0].description}')
         else:
@@ -149,39 +180,49 @@ def show(cmd, names: list = None):
     return _show_records_for_user(user, days)
 
 
+# longer histories are shown from the daily rollups, one line per workout a day
+_rollup_show_days = 30
+
+
 def _show_records_for_user(user: m.User, days: int):
+    catalog = m.workout_catalog()
     days_ago = datetime.utcnow() - timedelta(days=days)
-    records = m.WorkOutRecord.query.with_parent(user)\
-        .filter(m.WorkOutRecord.ts > days_ago) \
-        .order_by(desc(m.WorkOutRecord.ts)) \
-        .limit(1000)
-
-    def group_key(r: m.WorkOutRecord):
-        return r.workout.description, r.ts.date().isoformat()
-
-    def merge_records(sub_records):
-        lst = []
-        for i, sub_iter in itertools.groupby(r.times for r in sub_records):
-            count = len([_ for _ in sub_iter])
-            if count == 1:
-                lst.append(f'{i}')
-            else:
-                lst.append(f'{i}x{count}')
-        return ','.join(lst)
-
-    groups = itertools.groupby(records, group_key)
-
-    records_repr = '\n'.join(f'{date} :: {description}: {merge_records(sub_records)}'
-                             for ((description, date), sub_records) in groups)
+    if days > _rollup_show_days:
+        records_repr = '\n'.join(
+            f'{date} :: {catalog.get(workout_id).description}: {sets}组共{times}次'
+            for date, workout_id, sets, times
+            in m.daily_rollup_summary(user, days_ago.date()))
+    else:
+        records_repr = '\n'.join(
+            f'{date} :: {catalog.get(workout_id).description}: {format_groups(sets)}'
+            for date, workout_id, sets in m.record_summary(user, days_ago))
     if records_repr == '':
         return f'{user} 最近{days}天没有健身记录， 加油哦!'
     return f'{user} 最近{days}天的打卡记录:\n{records_repr}'
 
 
-@register_cmd(help_msg='显示运动排行榜')
+_rank_bucket_names = {'day': '今日', 'week': '本周', 'month': '本月', 'all': '总'}
+_rank_size = 10
+
+
+@register_cmd(help_msg='显示运动排行榜, 如: rank week kbsw')
 @parser(pct)
-def rank(cmd):
-    return f"workout ranking:"
+def rank(cmd, args: list = None):
+    bucket, family = 'all', m.LEADERBOARD_ALL_FAMILIES
+    for arg in args:
+        if arg in m.LEADERBOARD_BUCKETS:
+            bucket = arg
+        else:
+            family = m.workout_family(arg)
+    entries = m.leaderboard(bucket, family, limit=_rank_size)
+    title = _rank_bucket_names[bucket]
+    if family != m.LEADERBOARD_ALL_FAMILIES:
+        title = f'{title} {family} '
+    if len(entries) == 0:
+        return f'{title}排行榜暂无记录'
+    lines = '\n'.join(f'{i}. {user} :: {times}'
+                      for i, (user, times) in enumerate(entries, 1))
+    return f'{title}排行榜:\n{lines}'
 
 
 @register_cmd(help_msg='开启隐身模式')
@@ -192,7 +233,7 @@ def hideme(cmd, args=None):
         invisible = False
     g.user.invisible = invisible
     m.db.session.add(g.user)
-    m.db.session.commit()
+    m.commit()
     if invisible:
         return f"隐身模式开启"
     else:
@@ -215,7 +256,7 @@ def challenge(cmd, op_or_name=None):
         return ch.show_challenge_progresses()
     if op == 'recalculate':
         ch.recalculate_challenge_progress_for_user(g.user)
-        m.db.session.commit()
+        m.commit()
         return ch.show_challenge_progresses()
     challenge_name = op
     return ch.join_challenge(challenge_name)
@@ -238,26 +279,44 @@ def add_workout_type(cmd, args: list = None):
         return f'{name} 不是合法的运动名'
     workout = m.Workout(name=name, description=description)
     m.db.session.add(workout)
-    m.db.session.commit()
+    m.commit()
+    m.invalidate_workout_catalog()
     return f'成功添加: {name} - {description}'
 
 
 def is_workout_name(cmd):
-    not_operation_name = not any(item.is_triggered(cmd) for item in cmd_processors)
+    not_operation_name = dispatcher.lookup(cmd) is None
     return not_operation_name
 
 
-@parser(pcr)
-def workout(name, records):
-    logging.info("add records %s of workout %s for user %s", records, name, g.user_name)
+def pcr(cmdline):
+    return parse_command_with_record_groups(
+        cmdline,
+        max_sets=current_app.config.get('RECORD_MAX_SETS', MAX_SETS),
+        max_times=current_app.config.get('RECORD_MAX_TIMES', MAX_TIMES))
+
+
+def check_in(entries):
+    """
+    check in (workout name, groups) `entries` of the user with one pass over
+    the challenges, return one reply for all of them.
+    """
+    for name, groups in entries:
+        logging.info("add records %s of workout %s for user %s",
+                     format_groups(groups), name, g.user_name)
     try:
-        saved_records, workout = m.add_record(g.user, name, records)
-        updated_progresses =\
-            ch.update_challenge_progress_for_user(g.user, saved_records)
-        m.db.session.commit()
+        # in a batch `m.commit` only flushes, the savepoint keeps a failed
+        # check-in out of the batch
+        with m.db.session.begin_nested():
+            saved_records, workouts = m.add_records(g.user, entries)
+            updated_progresses =\
+                ch.update_challenge_progress_for_user(g.user, saved_records)
     except m.JsError as error:
         return error.msg
-    record_message = f'打卡:\n{workout.description}: {records}'
+    m.commit()
+    records = '\n'.join(f'{workout.description}: {format_groups(groups)}'
+                        for workout, (_, groups) in zip(workouts, entries))
+    record_message = f'打卡:\n{records}'
     if len(updated_progresses) == 0:
         return record_message
     else:
@@ -265,26 +324,75 @@ def workout(name, records):
                f'{ch.show_challenge_progresses(updated_progresses)}'
 
 
+@parser(pcr)
+def workout(name, groups):
+    return check_in([(name, groups)])
+
+
 _workout_processor = CmdRegisterItem(workout)
 
 
-def find_processor(cmd_line: str):
-    cmd = cmd_line.split()[0]
-    for processor in cmd_processors:
-        if processor.is_triggered(cmd):
-            return cmd, processor
-    if is_workout_name(cmd):
-        return cmd, _workout_processor
-    return cmd, None
+def find_processor(cmd_line):
+    """
+    find the processor of a command line, which is either the raw text or
+    a `CommandLine` parsed from it.
+    """
+    cmd = parse_command_line(cmd_line).name
+    processor = dispatcher.lookup(cmd)
+    if processor is None:
+        # not an operation name, so it is a workout name
+        processor = _workout_processor
+    return cmd, processor
 
 
-def process(cmd_line: str):
-    cmd, processor = find_processor(cmd_line)
+def process(cmd_line):
+    line = parse_command_line(cmd_line)
+    cmd, processor = find_processor(line)
     if processor is None:
         logging.error("command %s not supported", cmd)
         return
     logging.info("processing with %s", processor.name)
-    return processor.process(cmd_line)
+    return processor.process(line)
+
+
+def process_message(text):
+    """
+    process the command lines of a message in one transaction. the check-ins
+    among them are added together, the other commands run in order, and the
+    replies are joined.
+
+    a check-in line may hold several check-ins separated by ';', the
+    arguments of other commands are taken as they are.
+    """
+    lines = split_command_lines(text)
+    if len(lines) == 0:
+        return process(text)
+    if len(lines) == 1 and ';' not in lines[0]:
+        return process(lines[0])
+    check_ins, others, replies = [], [], []
+    for line in map(parse_command_line, lines):
+        _, processor = find_processor(line)
+        if processor is not _workout_processor:
+            others.append(line)
+            continue
+        for part in line.text.split(';'):
+            if not part.strip():
+                continue
+            try:
+                check_ins.append(pcr(part))
+            except ParseError as error:
+                replies.append(f'无法解析: {error.text}')
+    try:
+        with m.batch_transaction():
+            if check_ins:
+                replies.insert(0, check_in(check_ins))
+            replies.extend(process(line) for line in others)
+        m.commit()
+    except Exception:
+        # the check-ins flushed before must not be committed by the next one
+        m.db.session.rollback()
+        raise
+    return '\n\n'.join(reply for reply in replies if reply)
 
 
 if __name__ == '__main__':
@@ -3,36 +3,110 @@
 # author: Ji.Zhilong <zhilongji@gmail.com>
 # date: 17/03/2019
 
-from flask import request, g, jsonify
-from .commands import find_processor
+from flask import current_app, request, g, jsonify
+from .commands import find_processor, process_message
+from .parsers import parse_command_line
 from .app import create_app
 from . import models as m
-import requests
+from .cmdlog import create_command_log
 
+import atexit
 import logging
+import re
+import threading
 
 app = create_app()
 
+_sender = None
+_sender_lock = threading.Lock()
+# None until the first commands are logged, False if the command log is off
+_command_log = None
+_command_log_lock = threading.Lock()
+
+
+def get_sender():
+    """
+    the outbound sender of this process, started on first use so that
+    pre-forking servers start its threads in each worker.
+    """
+    global _sender
+    with _sender_lock:
+        if _sender is None:
+            # imports requests, which only the outbound calls need
+            from .outbound import OutboundSender
+            _sender = OutboundSender(app.config['TELEGRAM_API_URL'],
+                                     workers=app.config['TELEGRAM_SENDER_WORKERS'],
+                                     queue_size=app.config['TELEGRAM_SENDER_QUEUE_SIZE'])
+            _sender.start()
+            atexit.register(_sender.stop)
+        return _sender
+
+
+def log_command(user_id, text):
+    """
+    hold back a received command for the command log until the transaction
+    of the request commits, see `flush_command_log`.
+    """
+    g.setdefault('_pending_commands', []).append((user_id, text))
+
+
+def flush_command_log():
+    """
+    enqueue the commands held back in the current app context for the
+    command log writer of this process, started on first use like the
+    outbound sender. call it once the commands committed, a new user they
+    refer to may not exist before.
+    """
+    global _command_log
+    pending = g.pop('_pending_commands', [])
+    if not pending:
+        return
+    with _command_log_lock:
+        if _command_log is None:
+            _command_log = create_command_log(current_app)
+            if _command_log is None:
+                _command_log = False
+            else:
+                _command_log.start()
+                atexit.register(_command_log.stop)
+    if _command_log is False:
+        return
+    for user_id, text in pending:
+        _command_log.submit(user_id, text)
+
+
+def run_committed(process, data):
+    """
+    run `process` on the `data` of a webhook call, commit its work and then
+    log its commands.
+    """
+    response = process(data)
+    m.commit()
+    flush_command_log()
+    return response
+
+
+def handle_telegram(data):
+    """
+    process a telegram update in its own transaction, return the reply
+    going in the webhook response as a bot api method call, or None, and
+    the messages to send with an outbound sender.
+    """
+    response = run_committed(process_telegram, data)
+    if response is None:
+        return None, []
+    messages = split_message(response)
+    if current_app.config['TELEGRAM_WEBHOOK_REPLY'] and len(messages) == 1:
+        return dict(method='sendMessage', **messages[0]), []
+    return None, messages
+
 
 @app.route("/js", methods=['POST'])
 def bearychat():
     """
     receive POST from beary chat, dispatch to proper sub commands.
     """
-    data = request.get_json()
-    r = BearyChatRequest(data)
-    cmd, processor = find_processor(r.cmd)
-    response = {}
-    if processor is None:
-        response['text'] = f'不存在此命令: {cmd}'
-        return jsonify(response)
-    g.user = m.get_user(r.user_id)
-    if g.user is None:
-        response['text'] = f"{r.user_id} 不存在"
-        return jsonify(response)
-    g.user_name = r.user_name
-    response['text'] = processor.process(r.cmd)
-    return jsonify(response)
+    return jsonify(run_committed(process_bearychat, request.get_json()))
 
 
 @app.route("/bot/<token>", methods=['POST'])
@@ -40,35 +114,108 @@ def telegram(token):
     """
     receive POST from telegram, dispatch to proper sub commands.
 
+    in webhook reply mode a single short reply is returned in the response
+    body as a `sendMessage` method call, otherwise (or when the reply has to
+    be split into several messages) it is queued for the background
+    outbound sender.
+
     :param token: telegram bot token
-    :return: fixed string for ack the message
+    :return: the reply as a bot api method call, or fixed string for ack the message
     """
 
     try:
-        response = _do_process_telegram()
-        requests\
-            .post(f'https://api.telegram.org/bot{token}/sendMessage',
-                  json=response, timeout=2)\
-            .raise_for_status()
+        reply, messages = handle_telegram(request.get_json())
+        if reply is not None:
+            return jsonify(reply)
+        for message in messages:
+            get_sender().submit(token, 'sendMessage', message)
     except Exception:
         logging.exception("get error")
     return 'ok'
 
 
-def _do_process_telegram():
-    data = request.get_json()
+@app.route("/stats/outbound", methods=['GET'])
+def outbound_stats():
+    """
+    queue depth, delivery counters and latency of the outbound sender, an
+    empty report before it started.
+    """
+    if _sender is None:
+        return jsonify({})
+    return jsonify(_sender.report())
+
+
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+
+def split_message(response, limit=TELEGRAM_MAX_MESSAGE_LENGTH):
+    """
+    split a sendMessage payload into payloads whose text fits in one
+    telegram message, breaking at line boundaries where possible.
+    """
+    text = response['text']
+    if len(text) <= limit:
+        return [response]
+    chunks = []
+    current = ''
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            chunks.append(current)
+            current = ''
+        current += line
+    if current:
+        chunks.append(current)
+    return [dict(response, text=chunk) for chunk in chunks]
+
+
+def process_bearychat(data):
+    """
+    the reply to a bearychat message, in an app context. the caller
+    commits, see `run_committed`.
+    """
+    r = BearyChatRequest(data)
+    line = parse_command_line(r.cmd)
+    cmd, processor = find_processor(line)
+    response = {}
+    if processor is None:
+        response['text'] = f'不存在此命令: {cmd}'
+        return response
+    g.user = m.get_user(r.user_id)
+    if g.user is None:
+        response['text'] = f"{r.user_id} 不存在"
+        return response
+    g.user_name = r.user_name
+    log_command(g.user.id, r.cmd)
+    response['text'] = process_message(r.cmd)
+    return response
+
+
+def process_telegram(data):
+    """
+    the sendMessage payload replying to a telegram update, in an app
+    context, or None if the update is not a bot command. the caller
+    commits, see `run_committed`.
+    """
     reason, r = TelegramRequest.validate(data)
     if r is None:
         logging.warning("not valid telegram bot command request: " + reason)
         return
-    cmd, processor = find_processor(r.cmd)
+    line = parse_command_line(r.cmd)
+    cmd, processor = find_processor(line)
     response = {'chat_id': r.chat, 'reply_to_message_id': r.message_id, 'parse_mode': 'Markdown'}
     if processor is None:
         response['text'] = f'不存在此命令: {cmd}'
         return response
     g.user, _ = m.get_or_create_user(r.user_id)
     g.user_name = r.user_name
-    response['text'] = processor.process(r.cmd)
+    log_command(g.user.id, r.cmd)
+    response['text'] = process_message(r.cmd)
     return response
 
 
@@ -108,7 +255,9 @@ class TelegramRequest:
 
     @property
     def cmd(self):
-        return self.data['message']['text'].lstrip('/').replace('_', '-')
+        # every command line of the message may start with a slash
+        text = re.sub(r'(^|[\n;])\s*/', r'\1', self.data['message']['text'])
+        return text.replace('_', '-')
 
     @property
     def user_id(self):
@@ -123,5 +272,108 @@ class TelegramRequest:
         return self.data['message']['chat']['id']
 
 
+def test_split_message():
+    response = {'chat_id': 1, 'text': 'short'}
+    assert split_message(response) == [response]
+
+    response = {'chat_id': 1, 'text': 'aaaa\nbbbb\ncc'}
+    messages = split_message(response, limit=6)
+    assert [m['text'] for m in messages] == ['aaaa\n', 'bbbb\n', 'cc']
+    assert all(m['chat_id'] == 1 for m in messages)
+
+    messages = split_message({'text': 'a' * 13}, limit=5)
+    assert [m['text'] for m in messages] == ['aaaaa', 'aaaaa', 'aaa']
+
+
+def test_outbound_stats_do_not_start_the_sender():
+    assert _sender is None
+    assert app.test_client().get('/stats/outbound').get_json() == {}
+    assert _sender is None
+
+
+def test_command_log_off_is_remembered(monkeypatch):
+    from . import main
+    from .app import _create_app_with_env
+
+    created = []
+
+    def create(app):
+        created.append(app)
+        return None
+
+    monkeypatch.setattr(main, '_command_log', None)
+    monkeypatch.setattr(main, 'create_command_log', create)
+    test_app = _create_app_with_env(JS_DATABASE_URI='sqlite://', JS_COMMAND_LOG='off')
+    for text in ['kbsw-16 50', 'pullup 10']:
+        with test_app.app_context():
+            log_command('1', text)
+            flush_command_log()
+    assert len(created) == 1
+    assert main._command_log is False
+
+
+def test_process_multi_command_message(monkeypatch):
+    import copy
+
+    from . import challenges as ch
+    from . import commands
+    from .app import _create_app_with_env
+    from .samples import telegram_request_sample
+
+    def update(text):
+        result = copy.deepcopy(telegram_request_sample)
+        result['message']['text'] = text
+        return result
+
+    def records():
+        return m.WorkOutRecord.query.count()
+
+    test_app = _create_app_with_env(JS_DATABASE_URI='sqlite://', JS_COMMAND_LOG='off')
+    with test_app.app_context():
+        m.db.create_all()
+        m.Workout.create_builtin_workouts()
+        response = process_telegram(update('/kbsw_16 5x50; pullup 10\n/hideme on'))
+        assert response['text'] == '打卡:\n16公斤壶铃摆荡: 5x50\n自重引体向上: 10\n\n隐身模式开启'
+        assert records() == 2
+        assert m.LeaderboardEntry.query.filter_by(
+            bucket='day', family=m.LEADERBOARD_ALL_FAMILIES).one().times == 260
+
+        # an unknown workout rejects all the check-ins of the message
+        response = process_telegram(update('/kbsw_16 50; nosuchworkout 10; pullup 1x'))
+        assert response['text'] == '项目: nosuchworkout 不存在\n\n无法解析: 1x'
+        assert records() == 2
+
+        # only check-in lines are split on ';'
+        response = process_telegram(update('/kbsw_16 50\n/add_workout plank 平板;支撑'))
+        assert response['text'] == '打卡:\n16公斤壶铃摆荡: 50\n\n成功添加: plank - 平板;支撑'
+        assert records() == 3
+
+        # a check-in failing after it was flushed is rolled back, also when
+        # the message is part of a batch
+        def failing_update(user, saved_records):
+            raise m.JsError('挑战更新失败')
+
+        with monkeypatch.context() as patch:
+            patch.setattr(ch, 'update_challenge_progress_for_user', failing_update)
+            with m.batch_transaction():
+                response = process_telegram(update('/kbsw_16 50\n/pullup 10'))
+            m.db.session.commit()
+        assert response['text'] == '挑战更新失败'
+        assert records() == 3
+
+        # a raising command rolls back the check-ins of its message
+        def boom(cmdline):
+            raise RuntimeError('boom')
+
+        monkeypatch.setitem(commands.dispatcher.by_name, 'boom',
+                            commands.CmdRegisterItem(boom, predicate='boom'))
+        try:
+            process_telegram(update('/kbsw_16 50\n/boom now'))
+        except RuntimeError:
+            pass
+        m.db.session.commit()
+        assert records() == 3
+
+
 if __name__ == '__main__':
     pass
@@ -1,8 +1,16 @@
+import datetime
+import multiprocessing
+import os
+import random
+import time
+
 from flask_migrate import Migrate, MigrateCommand
 from flask_script import Manager
 
 from .app import create_app
 from . import models  as m
+from . import challenges as ch
+from .parsers import format_groups
 
 app = create_app()
 migrate = Migrate(app, m.db)
@@ -22,5 +30,260 @@ def rename(old_name, new_name):
     print(f'renamed {old_name} to {new_name}')
 
 
+@manager.command
+def rebuild_leaderboard():
+    m.rebuild_leaderboard()
+    print(f'rebuilt {m.LeaderboardEntry.query.count()} leaderboard entries')
+
+
+@manager.command
+def backfill_rollup():
+    m.rebuild_daily_rollup()
+    print(f'rebuilt {m.DailyRollup.query.count()} daily rollups')
+
+
+# typical reps per set of the workout families, and of the bodyweight squat
+_SYNTHETIC_REPS = {
+    'kbsw': (20, 60), 'kbdl': (8, 20), 'kbsq': (8, 20), 'kbcl': (5, 12),
+    'kbsn': (5, 12), 'kbpr': (3, 10), 'squat': (3, 10), 'dlift': (1, 8),
+    'pullup': (3, 15), 'pushup': (10, 40), 'parbar': (5, 20), 'burpee': (10, 30),
+}
+
+
+def _synthetic_sets(rnd, workout_name):
+    """
+    a check-in of straight sets, descending sets or a single set, as
+    (times, sets text).
+    """
+    lo, hi = _SYNTHETIC_REPS.get(m.workout_family(workout_name), (5, 20))
+    if workout_name == 'squat':
+        lo, hi = 15, 50
+    reps = rnd.randint(lo, hi)
+    kind = rnd.random()
+    if kind < .5:
+        groups = [(reps, rnd.randint(3, 6))]
+    elif kind < .8 and reps > lo:
+        groups = [(reps, 1), (rnd.randint(lo, reps - 1), rnd.randint(2, 5))]
+    else:
+        groups = [(reps, 1)]
+    return sum(t * c for t, c in groups), format_groups(groups)
+
+
+def _bulk_insert(engine, table, columns, rows):
+    """
+    insert tuples of `columns` with one executemany on the dbapi cursor,
+    without the per row parameter processing of sqlalchemy.
+    """
+    if not rows:
+        return
+    compiled = table.insert().compile(dialect=engine.dialect, column_keys=columns)
+    if engine.dialect.positional:
+        assert tuple(compiled.positiontup) == columns, compiled.positiontup
+    else:
+        rows = [dict(zip(columns, row)) for row in rows]
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.executemany(str(compiled), rows)
+        cursor.close()
+        connection.commit()
+    finally:
+        connection.close()
+
+
+@manager.option('-u', '--users', dest='users', type=int, default=1000)
+@manager.option('-y', '--years', dest='years', type=float, default=2)
+@manager.option('-s', '--seed', dest='seed', type=int, default=0)
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=100000)
+@manager.option('--keep-indexes', dest='keep_indexes', action='store_true', default=False,
+                help='insert into indexed tables instead of indexing after the load')
+@manager.option('--until', dest='until', default=None,
+                help='last day of the history as YYYY-MM-DD, today by default')
+def generate(users=1000, years=2, seed=0, batch_size=100000, until=None,
+             keep_indexes=False):
+    """
+    fill the database with synthetic users, records, challenge progresses and
+    commands. the same seed and --until give the same rows.
+    """
+    rnd = random.Random(seed)
+    until = datetime.datetime.strptime(until, '%Y-%m-%d') if until \
+        else datetime.datetime.combine(datetime.date.today(), datetime.time())
+    days = int(years * 365)
+    first_day = until - datetime.timedelta(days=days - 1)
+    print(f'generating {users} users with history from {first_day:%Y-%m-%d} '
+          f'to {until:%Y-%m-%d}, seed {seed}')
+
+    m.Workout.create_builtin_workouts()
+    m.Challenge.create_builtin_challenges()
+    workouts = {w.name: w.id for w in m.Workout.query.order_by(m.Workout.id)}
+    workout_names = sorted(workouts)
+    weights = {name: m.workout_weight(name) for name in workouts}
+    challenge_ids = [c.id for c in m.Challenge.query.order_by(m.Challenge.id)]
+    first_user_id = (m.db.session.query(m.db.func.max(m.User.id)).scalar() or 0) + 1
+    record_id = m.db.session.query(m.db.func.max(m.WorkOutRecord.id)).scalar() or 0
+    m.db.session.commit()
+    engine = m.db.engine
+
+    profiles = []
+    joins = {}
+    for user_id in range(first_user_id, first_user_id + users):
+        joined = int(days * rnd.random() ** 2)
+        favorites = {}
+        for name in rnd.sample(workout_names, rnd.randint(1, 4)):
+            favorites[name] = [_synthetic_sets(rnd, name) for _ in range(3)]
+        profiles.append((user_id, joined, rnd.randint(1, 6) / 7, list(favorites.items())))
+        for challenge_id in rnd.sample(challenge_ids, rnd.randint(0, 3)):
+            joins.setdefault(rnd.randint(joined, days - 1), []).append((user_id, challenge_id))
+    engine.execute(m.User.__table__.insert(), [
+        {'id': user_id, 'name': f'synthetic{user_id}', 'invisible': rnd.random() < .05}
+        for user_id, *_ in profiles
+    ])
+
+    record_columns = ('id', 'ts', 'times', 'sets', 'tonnage', 'workout_id', 'user_id')
+    command_columns = ('text', 'ts', 'user_id')
+    # sqlite stores datetimes as text, formatted the way sqlalchemy does
+    if engine.dialect.name == 'sqlite':
+        def db_ts(date, prefix, seconds):
+            minutes, second = divmod(seconds, 60)
+            return f'{prefix}{minutes // 60:02}:{minutes % 60:02}:{second:02}.000000'
+    else:
+        def db_ts(date, prefix, seconds):
+            return date + datetime.timedelta(seconds=seconds)
+
+    # building an index once after the load beats updating it row by row
+    indexes = [] if keep_indexes else \
+        list(m.WorkOutRecord.__table__.indexes | m.Command.__table__.indexes)
+    for index in indexes:
+        index.drop(engine)
+
+    started = time.perf_counter()
+    counts = {'records': 0, 'commands': 0, 'progresses': 0}
+    records, commands, progresses = [], [], []
+
+    def flush():
+        _bulk_insert(engine, m.WorkOutRecord.__table__, record_columns, records)
+        _bulk_insert(engine, m.Command.__table__, command_columns, commands)
+        counts['records'] += len(records)
+        counts['commands'] += len(commands)
+        records.clear()
+        commands.clear()
+
+    for day in range(days):
+        date = first_day + datetime.timedelta(days=day)
+        prefix = f'{date:%Y-%m-%d} '
+        for user_id, challenge_id in joins.get(day, ()):
+            progresses.append({
+                'user_id': user_id, 'challenge_id': challenge_id, 'achieved': 0,
+                'finished': False, 'start_record_id': record_id,
+                'latest_record_id': record_id})
+        check_ins = []
+        for user_id, joined, frequency, favorites in profiles:
+            if joined > day or rnd.random() >= frequency:
+                continue
+            for name, patterns in rnd.sample(favorites, min(len(favorites), rnd.randint(1, 2))):
+                seconds = rnd.randint(6 * 3600, 23 * 3600)
+                check_ins.append((seconds, user_id, name, rnd.choice(patterns)))
+            if rnd.random() < .2:
+                commands.append(('show', db_ts(date, prefix, 23 * 3600), user_id))
+        check_ins.sort()
+        for seconds, user_id, name, (times, sets) in check_ins:
+            record_id += 1
+            ts = db_ts(date, prefix, seconds)
+            records.append((record_id, ts, times, sets, times * weights[name],
+                            workouts[name], user_id))
+            commands.append((f'{name} {sets}', ts, user_id))
+        if len(records) >= batch_size:
+            flush()
+            elapsed = time.perf_counter() - started
+            print(f'{date:%Y-%m-%d}: {counts["records"]} records, '
+                  f'{counts["records"] / elapsed:.0f} records/s')
+    flush()
+    for index in indexes:
+        print(f'creating index {index.name} ...')
+        index.create(engine)
+    if progresses:
+        engine.execute(m.ChallengeProgress.__table__.insert(), progresses)
+    counts['progresses'] = len(progresses)
+    elapsed = time.perf_counter() - started
+    rows = sum(counts.values())
+    print(f'generated {counts["records"]} records, {counts["commands"]} commands and '
+          f'{counts["progresses"]} challenge progresses in {elapsed:.2f}s '
+          f'({rows / max(elapsed, 1e-9):.0f} rows/s)')
+    print('run recalculate, rebuild_leaderboard and backfill_rollup to derive '
+          'the challenge progresses, leaderboard and daily rollups')
+
+
+_worker_app = None
+
+
+def _init_recalculate_worker():
+    # every worker process gets its own engine, hence its own connection
+    global _worker_app
+    _worker_app = create_app()
+
+
+def _recalculate_chunk(args):
+    user_ids, dry_run = args
+    started = time.perf_counter()
+    changed = 0
+    with _worker_app.app_context():
+        for user in m.User.query.filter(m.User.id.in_(user_ids)):
+            before = {p.id: (p.achieved, p.finished) for p in user.challenges}
+            ch.recalculate_challenge_progress_for_user(user)
+            changed += sum(1 for p in user.challenges
+                           if before[p.id] != (p.achieved, p.finished))
+        if dry_run:
+            m.db.session.rollback()
+        else:
+            m.db.session.commit()
+        m.db.session.remove()
+    return max(user_ids), len(user_ids), changed, time.perf_counter() - started
+
+
+@manager.option('-u', '--users', dest='users', default=None,
+                help='comma separated user names, all users by default')
+@manager.option('-w', '--workers', dest='workers', type=int, default=4)
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int, default=100)
+@manager.option('--checkpoint', dest='checkpoint', default=None,
+                help='file recording the last finished user id, to resume from')
+@manager.option('--dry-run', dest='dry_run', action='store_true', default=False,
+                help='recalculate without committing')
+def recalculate(users=None, workers=4, chunk_size=100, checkpoint=None, dry_run=False):
+    """
+    recalculate challenge progresses of all (or the given) users in parallel.
+    """
+    start_after = 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            start_after = int(f.read().strip() or 0)
+        print(f'resuming after user id {start_after}')
+    query = m.db.session.query(m.User.id).filter(m.User.id > start_after)
+    if users is not None:
+        query = query.filter(m.User.name.in_(users.split(',')))
+    user_ids = [user_id for user_id, in query.order_by(m.User.id)]
+    m.db.session.remove()
+    m.db.engine.dispose()
+    chunks = [(user_ids[i:i + chunk_size], dry_run)
+              for i in range(0, len(user_ids), chunk_size)]
+
+    started = time.perf_counter()
+    done = changed = 0
+    with multiprocessing.Pool(workers, initializer=_init_recalculate_worker) as pool:
+        # results come back in order, so the checkpoint never skips a chunk
+        for last_id, count, chunk_changed, _ in pool.imap(_recalculate_chunk, chunks):
+            done += count
+            changed += chunk_changed
+            elapsed = time.perf_counter() - started
+            print(f'{done}/{len(user_ids)} users, up to id {last_id}, '
+                  f'{changed} progresses changed, {done / elapsed:.1f} users/s')
+            if checkpoint is not None and not dry_run:
+                with open(checkpoint, 'w') as f:
+                    f.write(str(last_id))
+    elapsed = time.perf_counter() - started
+    action = 'would change' if dry_run else 'changed'
+    print(f'recalculated {done} users in {elapsed:.2f}s '
+          f'({done / max(elapsed, 1e-9):.1f} users/s), {action} {changed} progresses')
+
+
 if __name__ == '__main__':
     manager.run()
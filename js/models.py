@@ -1,14 +1,70 @@
+import collections
+import contextlib
 import datetime
+import functools
+import itertools
 import logging
+import threading
+import time
 
+import flask
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import desc, event, func, inspect
+from sqlalchemy.exc import IntegrityError
 
-db = SQLAlchemy()
+from .parsers import format_groups, parse_groups
+
+
+class _SQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, info, options):
+        # flask-sqlalchemy 2.3 only reads a few pool settings from the config
+        # and updates `options` in place, 2.4 and later return (url, options)
+        result = super().apply_driver_hacks(app, info, options)
+        if result is not None:
+            info, options = result
+        options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        return info, options
+
+
+db = _SQLAlchemy()
+
+# set on every new sqlite connection: write ahead logging lets readers run
+# while a worker writes, and busy_timeout makes writers wait for the lock
+# instead of failing with "database is locked".
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -16 * 1024,
+}
+
+
+def _set_sqlite_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+
+def _begin_before_savepoint(connection, name):
+    # pysqlite only begins a transaction before a write, a SAVEPOINT issued
+    # before that would start one itself and its RELEASE commit it. savepoints
+    # are taken on the way to a write, so begin by taking the write lock,
+    # which waits for busy_timeout like the writes do.
+    dbapi_connection = connection.connection
+    if not dbapi_connection.in_transaction:
+        dbapi_connection.execute('BEGIN IMMEDIATE')
 
 
 def init_app(app):
     db.init_app(app)
+    engine = db.get_engine(app)
+    if engine.dialect.name == 'sqlite':
+        pragmas = dict(SQLITE_PRAGMAS, **app.config.get('SQLITE_PRAGMAS', {}))
+        event.listen(engine, 'connect',
+                     functools.partial(_set_sqlite_pragmas, pragmas))
+        event.listen(engine, 'savepoint', _begin_before_savepoint)
 
 
 class JsError(Exception):
@@ -17,6 +73,44 @@ class JsError(Exception):
         self.msg = msg
 
 
+def _request_memo(name):
+    """
+    a dict living as long as the current app context, i.e. the request.
+    """
+    if not flask.has_app_context():
+        return {}
+    memo = flask.g.get(f'_memo_{name}')
+    if memo is None:
+        memo = {}
+        setattr(flask.g, f'_memo_{name}', memo)
+    return memo
+
+
+def commit():
+    """
+    commit the work of a command, or only flush it while the commands of a
+    batch share one transaction, see `batch_transaction`.
+    """
+    if flask.has_app_context() and flask.g.get('_batch_transaction'):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+@contextlib.contextmanager
+def batch_transaction():
+    """
+    turn the `commit` calls of the commands run inside into flushes, the
+    caller commits or rolls back the batch.
+    """
+    outer = flask.g.get('_batch_transaction', False)
+    flask.g._batch_transaction = True
+    try:
+        yield
+    finally:
+        flask.g._batch_transaction = outer
+
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), unique=True, nullable=False)
@@ -24,13 +118,34 @@ class User(db.Model):
     records = db.relationship('WorkOutRecord', backref='user', lazy=True)
     commands = db.relationship('Command', backref='user', lazy=True)
 
+    # number of finished challenge progresses, kept by `set_finished_challenges`
+    # and `add_finished_challenge`
+    finished_challenges = db.Column(db.Integer, nullable=False, default=0,
+                                    server_default='0')
+
     def __repr__(self):
-        return f'{self.name}{self.badges}'
+        key = inspect(self).identity
+        memo = _request_memo('user_repr')
+        if key is None or key not in memo:
+            text = f'{self.name}{self.badges}'
+            if key is None:
+                return text
+            memo[key] = text
+        return memo[key]
+
+    def set_finished_challenges(self, number):
+        self.finished_challenges = number
+        _request_memo('user_repr').pop(inspect(self).identity, None)
+
+    def add_finished_challenge(self):
+        # increment in sql, so challenges finished by concurrent check-ins are
+        # not lost, and flush before a second one or the badges read it
+        self.set_finished_challenges(User.finished_challenges + 1)
+        db.session.flush()
 
     @property
     def badges(self):
-        finished_challenge_no = ChallengeProgress.query\
-            .with_parent(self).filter_by(finished=True).count()
+        finished_challenge_no = self.finished_challenges or 0
         badge = '🏋'
         numbers = '⓪①②③④⑤⑥⑦⑧⑨⑩⑪⑫⑬⑭⑮⑯⑰⑱⑲⑳㉑㉒㉓㉔㉕㉖㉗㉘㉙㉚㉛㉜㉝㉞㉟㊱㊲㊳㊴㊵㊶㊷㊸㊹㊺㊻㊼㊽㊾㊿'
         if finished_challenge_no == 0:
@@ -43,6 +158,10 @@ class User(db.Model):
 
 
 class Command(db.Model):
+    __table_args__ = (
+        db.Index('ix_command_user_id_ts', 'user_id', 'ts'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.String(128), nullable=False)
     ts = db.Column(db.DateTime, default=datetime.datetime.utcnow)
@@ -51,6 +170,42 @@ class Command(db.Model):
                         nullable=False)
 
 
+def _seed_by_name(model, rows):
+    """
+    insert the seed `rows` whose names are not in the table of `model` yet,
+    with one query for the existing names and one bulk insert.
+    """
+    existing = {name for name, in db.session.query(model.name)}
+    missing = [row for row in rows if row['name'] not in existing]
+    if missing:
+        db.session.execute(model.__table__.insert(), missing)
+    db.session.commit()
+
+
+_KETTLEBELL_WEIGHTS = (4, 8, 12, 16, 24)
+_BARBELL_WEIGHTS = (20, 40, 50, 60, 70, 80, 90, 100, 110, 120, 130, 140)
+
+BUILTIN_WORKOUTS = [
+    {'name': f'{name}-{weight}', 'description': f'{weight}公斤{description}'}
+    for name, description in [('kbsw', '壶铃摆荡'), ('kbdl', '壶铃硬拉'),
+                              ('kbsq', '壶铃深蹲'), ('kbcl', '壶铃高翻'),
+                              ('kbsn', '壶铃抓举'), ('kbpr', '壶铃实力举')]
+    for weight in _KETTLEBELL_WEIGHTS
+] + [
+    {'name': 'squat', 'description': '徒手深蹲'},
+] + [
+    {'name': f'{name}-{weight}', 'description': f'{weight}公斤{description}'}
+    for name, description in [('squat', '颈后深蹲'), ('dlift', '硬拉')]
+    for weight in _BARBELL_WEIGHTS
+] + [
+    {'name': 'pullup', 'description': '自重引体向上'},
+    {'name': 'pullup-aid', 'description': '辅助引体向上'},
+    {'name': 'pushup', 'description': '俯卧撑'},
+    {'name': 'parbar-press', 'description': '双杠臂屈伸'},
+    {'name': 'burpee', 'description': '波比跳'},
+]
+
+
 class Workout(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), unique=True, nullable=False)
@@ -62,88 +217,122 @@ class Workout(db.Model):
 
     @staticmethod
     def create_builtin_workouts():
-        workouts = [
-            Workout(name='kbsw-4', description='4公斤壶铃摆荡'),
-            Workout(name='kbsw-8', description='8公斤壶铃摆荡'),
-            Workout(name='kbsw-12', description='12公斤壶铃摆荡'),
-            Workout(name='kbsw-16', description='16公斤壶铃摆荡'),
-            Workout(name='kbsw-24', description='24公斤壶铃摆荡'),
-
-            Workout(name='kbdl-4', description='4公斤壶铃硬拉'),
-            Workout(name='kbdl-8', description='8公斤壶铃硬拉'),
-            Workout(name='kbdl-12', description='12公斤壶铃硬拉'),
-            Workout(name='kbdl-16', description='16公斤壶铃硬拉'),
-            Workout(name='kbdl-24', description='24公斤壶铃硬拉'),
-
-            Workout(name='kbsq-4', description='4公斤壶铃深蹲'),
-            Workout(name='kbsq-8', description='8公斤壶铃深蹲'),
-            Workout(name='kbsq-12', description='12公斤壶铃深蹲'),
-            Workout(name='kbsq-16', description='16公斤壶铃深蹲'),
-            Workout(name='kbsq-24', description='24公斤壶铃深蹲'),
-
-            Workout(name='kbcl-4', description='4公斤壶铃高翻'),
-            Workout(name='kbcl-8', description='8公斤壶铃高翻'),
-            Workout(name='kbcl-12', description='12公斤壶铃高翻'),
-            Workout(name='kbcl-16', description='16公斤壶铃高翻'),
-            Workout(name='kbcl-24', description='24公斤壶铃高翻'),
-
-            Workout(name='kbsn-4', description='4公斤壶铃抓举'),
-            Workout(name='kbsn-8', description='8公斤壶铃抓举'),
-            Workout(name='kbsn-12', description='12公斤壶铃抓举'),
-            Workout(name='kbsn-16', description='16公斤壶铃抓举'),
-            Workout(name='kbsn-24', description='24公斤壶铃抓举'),
-
-            Workout(name='kbpr-4', description='4公斤壶铃实力举'),
-            Workout(name='kbpr-8', description='8公斤壶铃实力举'),
-            Workout(name='kbpr-12', description='12公斤壶铃实力举'),
-            Workout(name='kbpr-16', description='16公斤壶铃实力举'),
-            Workout(name='kbpr-24', description='24公斤壶铃实力举'),
-
-            Workout(name='squat', description='徒手深蹲'),
-            Workout(name='squat-20', description='20公斤颈后深蹲'),
-            Workout(name='squat-40', description='40公斤颈后深蹲'),
-            Workout(name='squat-50', description='50公斤颈后深蹲'),
-            Workout(name='squat-60', description='60公斤颈后深蹲'),
-            Workout(name='squat-70', description='70公斤颈后深蹲'),
-            Workout(name='squat-80', description='80公斤颈后深蹲'),
-            Workout(name='squat-90', description='90公斤颈后深蹲'),
-            Workout(name='squat-100', description='100公斤颈后深蹲'),
-            Workout(name='squat-110', description='110公斤颈后深蹲'),
-            Workout(name='squat-120', description='120公斤颈后深蹲'),
-            Workout(name='squat-130', description='130公斤颈后深蹲'),
-            Workout(name='squat-140', description='140公斤颈后深蹲'),
-
-            Workout(name='dlift-20', description='20公斤硬拉'),
-            Workout(name='dlift-40', description='40公斤硬拉'),
-            Workout(name='dlift-50', description='50公斤硬拉'),
-            Workout(name='dlift-60', description='60公斤硬拉'),
-            Workout(name='dlift-70', description='70公斤硬拉'),
-            Workout(name='dlift-80', description='80公斤硬拉'),
-            Workout(name='dlift-90', description='90公斤硬拉'),
-            Workout(name='dlift-100', description='100公斤硬拉'),
-            Workout(name='dlift-110', description='110公斤硬拉'),
-            Workout(name='dlift-120', description='120公斤硬拉'),
-            Workout(name='dlift-130', description='130公斤硬拉'),
-            Workout(name='dlift-140', description='140公斤硬拉'),
-
-            Workout(name='pullup', description='自重引体向上'),
-            Workout(name='pullup-aid', description='辅助引体向上'),
-
-            Workout(name='pushup', description='俯卧撑'),
-            Workout(name='parbar-press', description='双杠臂屈伸'),
-            Workout(name='burpee', description='波比跳'),
-        ]
-
-        for workout in workouts:
-            if Workout.query.filter_by(name=workout.name).first() is None:
-                db.session.add(workout)
-        db.session.commit()
+        _seed_by_name(Workout, BUILTIN_WORKOUTS)
+        invalidate_workout_catalog()
+
+
+CatalogWorkout = collections.namedtuple('CatalogWorkout', ['id', 'name', 'description'])
+
+
+class WorkoutCatalog:
+    """
+    snapshot of the workout table, keyed by name and by id, with workouts
+    grouped by family.
+
+    the snapshot is reloaded when `invalidate` is called, and at most every
+    `check_interval` seconds it checks the (count, max id) version of the
+    table, to pick up workouts added by other processes. a lookup missing
+    the snapshot checks the version right away, but at most every
+    `miss_interval` seconds, so unknown names do not query the table each
+    time.
+    """
+
+    check_interval = 5.
+    miss_interval = 1.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked_at = None
+        self.missed_at = None
+        self.by_name = {}
+        self.by_id = {}
+        self.families = []
+
+    def invalidate(self):
+        self.version = None
+        self.checked_at = None
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and self.checked_at is not None \
+                and now - self.checked_at < self.check_interval:
+            return self
+        with self.lock:
+            version = tuple(db.session.query(func.count(Workout.id),
+                                             func.max(Workout.id)).one())
+            if version != self.version:
+                self._load(version)
+            self.checked_at = now
+        return self
+
+    def _load(self, version):
+        workouts = [CatalogWorkout(w.id, w.name, w.description)
+                    for w in Workout.query.order_by(Workout.name)]
+        self.by_name = {w.name: w for w in workouts}
+        self.by_id = {w.id: w for w in workouts}
+        self.families = [(family, list(group)) for family, group in
+                         itertools.groupby(workouts, lambda w: workout_family(w.name))]
+        self.version = version
+
+    def _refresh_on_miss(self):
+        now = time.monotonic()
+        if self.missed_at is not None and now - self.missed_at < self.miss_interval:
+            return self
+        self.missed_at = now
+        return self.refresh(force=True)
+
+    def find(self, name):
+        """
+        workout of the name, or None if it does not exist.
+        """
+        workout = self.by_name.get(name)
+        if workout is None:
+            workout = self._refresh_on_miss().by_name.get(name)
+        return workout
+
+    def get(self, workout_id):
+        workout = self.by_id.get(workout_id)
+        if workout is None:
+            workout = self._refresh_on_miss().by_id[workout_id]
+        return workout
+
+
+def workout_catalog():
+    """
+    the workout catalog of the current app.
+    """
+    extensions = flask.current_app.extensions
+    catalog = extensions.get('js_workout_catalog')
+    if catalog is None:
+        catalog = extensions.setdefault('js_workout_catalog', WorkoutCatalog())
+    return catalog.refresh()
+
+
+def invalidate_workout_catalog():
+    workout_catalog().invalidate()
 
 
 class WorkOutRecord(db.Model):
+    """
+    one check-in of a workout, with all its sets.
+    """
+
+    __table_args__ = (
+        # history of a user in a time window
+        db.Index('ix_work_out_record_user_id_ts', 'user_id', 'ts'),
+        # records of a user after a challenge was joined
+        db.Index('ix_work_out_record_user_id_id', 'user_id', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     ts = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    # total times of all the sets
     times = db.Column(db.Integer, nullable=False)
+    # sets in run length format, e.g. '50x5,40'
+    sets = db.Column(db.String(1024), nullable=False)
+    # total times multiplied by the weight of the workout, in kilos
+    tonnage = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     workout_id = db.Column(db.Integer, db.ForeignKey('workout.id'),
                            nullable=False)
@@ -152,7 +341,36 @@ class WorkOutRecord(db.Model):
                         nullable=False)
 
     def __repr__(self):
-        return '%s-%s' % (self.workout.description, self.times)
+        return '%s-%s' % (workout_catalog().get(self.workout_id).description, self.sets)
+
+    @property
+    def groups(self):
+        """
+        sets as run length groups, [(times, count), ...]
+        """
+        return parse_groups(self.sets)
+
+    @property
+    def workout_name(self):
+        return workout_catalog().get(self.workout_id).name
+
+
+BUILTIN_CHALLENGES = [
+    {'name': 'kbsw-10000', 'description': '一万次壶铃摆荡', 'total': 10000},
+    {'name': 'pullup-500', 'description': '五百次引体向上', 'total': 500},
+    {'name': 'pullup-1000', 'description': '一千次引体向上', 'total': 1000},
+    {'name': 'squat-50', 'description': '累计深蹲50吨', 'total': 50*1000},
+    {'name': 'squat-100', 'description': '累计深蹲100吨', 'total': 100*1000},
+    {'name': 'squat-200', 'description': '累计深蹲200吨', 'total': 200*1000},
+    {'name': 'workout-30d', 'description': '连续打卡30天', 'total': 30},
+    {'name': 'workout-60d', 'description': '连续打卡60天', 'total': 60},
+    {'name': 'workout-100d', 'description': '连续打卡100天', 'total': 100},
+    {'name': 'pbpress-1000', 'description': '一千次双杠臂屈伸', 'total': 1000},
+    {'name': 'muscleup-1000', 'description': '一千次双力臂', 'total': 1000},
+    {'name': 'burpee-500', 'description': 'burpee挑五百次', 'total': 500},
+    {'name': 'burpee-1000', 'description': 'burpee挑一千次', 'total': 1000},
+    {'name': 'burpee-5000', 'description': 'burpee挑五千次', 'total': 5000},
+]
 
 
 class Challenge(db.Model):
@@ -164,40 +382,282 @@ class Challenge(db.Model):
 
     @staticmethod
     def create_builtin_challenges():
-        challenges = [
-            Challenge(name='kbsw-10000', description='一万次壶铃摆荡', total=10000),
-            Challenge(name='pullup-500', description='五百次引体向上', total=500),
-            Challenge(name='pullup-1000', description='一千次引体向上', total=1000),
-            Challenge(name='squat-50', description='累计深蹲50吨', total=50*1000),
-            Challenge(name='squat-100', description='累计深蹲100吨', total=100*1000),
-            Challenge(name='squat-200', description='累计深蹲200吨', total=200*1000),
-            Challenge(name='workout-30d', description='连续打卡30天', total=30),
-            Challenge(name='workout-60d', description='连续打卡60天', total=60),
-            Challenge(name='workout-100d', description='连续打卡100天', total=100),
-            Challenge(name='pbpress-1000', description='一千次双杠臂屈伸', total=1000),
-            Challenge(name='muscleup-1000', description='一千次双力臂', total=1000),
-            Challenge(name='burpee-500', description='burpee挑五百次', total=500),
-            Challenge(name='burpee-1000', description='burpee挑一千次', total=1000),
-            Challenge(name='burpee-5000', description='burpee挑五千次', total=5000),
-        ]
-        for c in challenges:
-            if Challenge.query.filter_by(name=c.name).first() is None:
-                db.session.add(c)
-        db.session.commit()
+        _seed_by_name(Challenge, BUILTIN_CHALLENGES)
 
     def __repr__(self):
         return f'{self.name}-{self.description}'
 
 
+def workout_family(workout_name):
+    """
+    'kbsw-16' -> 'kbsw', 'pullup' -> 'pullup'
+    """
+    return workout_name.split('-', 1)[0]
+
+
+def workout_weight(workout_name):
+    """
+    'kbsw-16' -> 16, 'pullup' -> 0, 'pullup-aid' -> 0
+    """
+    parts = workout_name.split('-', 1)
+    if len(parts) == 2 and parts[1].isdecimal():
+        return int(parts[1])
+    return 0
+
+
+LEADERBOARD_BUCKETS = ('day', 'week', 'month', 'all')
+LEADERBOARD_ALL_FAMILIES = '*'
+
+
+def bucket_start(bucket, dt):
+    """
+    first day of the time bucket which the datetime or date `dt` falls in.
+    """
+    date = dt.date() if isinstance(dt, datetime.datetime) else dt
+    if bucket == 'day':
+        return date
+    if bucket == 'week':
+        return date - datetime.timedelta(days=date.weekday())
+    if bucket == 'month':
+        return date.replace(day=1)
+    if bucket == 'all':
+        return datetime.date(1970, 1, 1)
+    raise ValueError(bucket)
+
+
+class LeaderboardEntry(db.Model):
+    """
+    workout times of a user in a family of workouts (or all workouts) during
+    a time bucket, maintained by `add_records`.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('bucket', 'bucket_start', 'family', 'user_id'),
+        db.Index('ix_leaderboard_entry_top',
+                 'bucket', 'bucket_start', 'family', 'times'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.String(8), nullable=False)
+    bucket_start = db.Column(db.Date, nullable=False)
+    family = db.Column(db.String(80), nullable=False)
+    times = db.Column(db.Integer, nullable=False, default=0)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        nullable=False)
+    user = db.relationship('User')
+
+
+def _insert_missing(rows, can_retry):
+    """
+    insert the `rows` an update did not find in a savepoint. return False if
+    a concurrent check-in inserted one of them since, the caller then looks
+    them up again and adds to them instead.
+    """
+    if not rows:
+        return True
+    try:
+        with db.session.begin_nested():
+            db.session.add_all(rows)
+    except IntegrityError:
+        if not can_retry:
+            raise
+        return False
+    return True
+
+
+def _update_leaderboard(user, check_ins, dt):
+    """
+    add the times of (workout, times) `check_ins` to the leaderboard entries
+    of the user, with one query for the existing entries.
+    """
+    keys = collections.Counter()
+    for workout, times in check_ins:
+        for bucket in LEADERBOARD_BUCKETS:
+            for family in (workout_family(workout.name), LEADERBOARD_ALL_FAMILIES):
+                keys[(bucket, bucket_start(bucket, dt), family)] += times
+    for attempt in range(2):
+        entries = LeaderboardEntry.query.filter_by(user_id=user.id)\
+            .filter(LeaderboardEntry.bucket_start.in_({k[1] for k in keys}),
+                    LeaderboardEntry.family.in_({k[2] for k in keys}))
+        for entry in entries:
+            key = (entry.bucket, entry.bucket_start, entry.family)
+            if key in keys:
+                # increment in sql, so concurrent check-ins are not lost
+                entry.times = LeaderboardEntry.times + keys.pop(key)
+        rows = [LeaderboardEntry(user_id=user.id, bucket=bucket, bucket_start=start,
+                                 family=family, times=times)
+                for (bucket, start, family), times in keys.items()]
+        if _insert_missing(rows, can_retry=attempt == 0):
+            return
+
+
+def leaderboard(bucket='all', family=LEADERBOARD_ALL_FAMILIES, limit=10, dt=None):
+    """
+    top `limit` visible users of the bucket containing `dt`, as (user, times).
+    """
+    start = bucket_start(bucket, dt or datetime.datetime.utcnow())
+    return db.session.query(User, LeaderboardEntry.times)\
+        .join(LeaderboardEntry.user)\
+        .filter(LeaderboardEntry.bucket == bucket,
+                LeaderboardEntry.bucket_start == start,
+                LeaderboardEntry.family == family,
+                func.coalesce(User.invisible, False).is_(False))\
+        .order_by(desc(LeaderboardEntry.times))\
+        .limit(limit)\
+        .all()
+
+
+def rebuild_leaderboard():
+    """
+    recompute all leaderboard entries from workout records, one user at a
+    time from the times of their workouts summed up by day in sql.
+    """
+    LeaderboardEntry.query.delete()
+    workouts = workout_catalog().by_id
+    day = func.date(WorkOutRecord.ts, type_=db.Date)
+    for user_id, in db.session.query(User.id).order_by(User.id).all():
+        rows = db.session.query(WorkOutRecord.workout_id, day, func.sum(WorkOutRecord.times))\
+            .filter(WorkOutRecord.user_id == user_id)\
+            .group_by(WorkOutRecord.workout_id, day)
+        totals = collections.Counter()
+        for workout_id, date, times in rows:
+            family = workout_family(workouts[workout_id].name)
+            for bucket in LEADERBOARD_BUCKETS:
+                for f in (family, LEADERBOARD_ALL_FAMILIES):
+                    totals[(bucket, bucket_start(bucket, date), f)] += times
+        db.session.bulk_insert_mappings(LeaderboardEntry, [
+            dict(user_id=user_id, bucket=bucket, bucket_start=start,
+                 family=family, times=times)
+            for (bucket, start, family), times in totals.items()
+        ])
+    db.session.commit()
+
+
+class DailyRollup(db.Model):
+    """
+    sets, times and tonnage of a workout done by a user in a day (in utc,
+    like every date of the service), maintained by `add_records`.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'date', 'workout_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False)
+    sets = db.Column(db.Integer, nullable=False, default=0)
+    times = db.Column(db.Integer, nullable=False, default=0)
+    tonnage = db.Column(db.Integer, nullable=False, default=0)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        nullable=False)
+    workout_id = db.Column(db.Integer, db.ForeignKey('workout.id'),
+                           nullable=False)
+
+
+def _update_daily_rollup(user, records, dt):
+    """
+    add (record, sets) `records` of the user checked in at `dt` to the
+    rollups of their workouts on that day.
+    """
+    totals = collections.OrderedDict()
+    for record, sets in records:
+        total = totals.setdefault(record.workout_id, [0, 0, 0])
+        total[0] += sets
+        total[1] += record.times
+        total[2] += record.tonnage
+    date = dt.date()
+    for attempt in range(2):
+        rollups = DailyRollup.query.filter(DailyRollup.user_id == user.id,
+                                           DailyRollup.date == date,
+                                           DailyRollup.workout_id.in_(totals))
+        for rollup in rollups:
+            sets, times, tonnage = totals.pop(rollup.workout_id)
+            # increment in sql, so concurrent check-ins are not lost
+            rollup.sets = DailyRollup.sets + sets
+            rollup.times = DailyRollup.times + times
+            rollup.tonnage = DailyRollup.tonnage + tonnage
+        rows = [DailyRollup(user_id=user.id, date=date, workout_id=workout_id,
+                            sets=sets, times=times, tonnage=tonnage)
+                for workout_id, (sets, times, tonnage) in totals.items()]
+        if _insert_missing(rows, can_retry=attempt == 0):
+            return
+
+
+def daily_rollup_summary(user, since):
+    """
+    daily rollups of the user from date `since` on, latest first, as
+    [(date, workout_id, sets, times), ...].
+    """
+    rows = db.session.query(DailyRollup.date, DailyRollup.workout_id,
+                            DailyRollup.sets, DailyRollup.times)\
+        .filter(DailyRollup.user_id == user.id, DailyRollup.date >= since)\
+        .order_by(desc(DailyRollup.date), desc(DailyRollup.id))
+    return [(date.isoformat(), workout_id, sets, times)
+            for date, workout_id, sets, times in rows]
+
+
+def rebuild_daily_rollup():
+    """
+    recompute all daily rollups from workout records, one user at a time
+    from their check-ins counted by day, workout and sets in sql.
+    """
+    DailyRollup.query.delete()
+    day = func.date(WorkOutRecord.ts, type_=db.Date)
+    for user_id, in db.session.query(User.id).order_by(User.id).all():
+        rows = db.session.query(day, WorkOutRecord.workout_id, WorkOutRecord.sets,
+                                func.count(WorkOutRecord.id), func.sum(WorkOutRecord.times),
+                                func.sum(WorkOutRecord.tonnage))\
+            .filter(WorkOutRecord.user_id == user_id)\
+            .group_by(day, WorkOutRecord.workout_id, WorkOutRecord.sets)
+        totals = {}
+        for date, workout_id, sets, count, times, tonnage in rows:
+            total = totals.setdefault((date, workout_id), [0, 0, 0])
+            total[0] += sum(c for _, c in parse_groups(sets)) * count
+            total[1] += times
+            total[2] += tonnage
+        db.session.bulk_insert_mappings(DailyRollup, [
+            dict(user_id=user_id, date=date, workout_id=workout_id,
+                 sets=sets, times=times, tonnage=tonnage)
+            for (date, workout_id), (sets, times, tonnage) in totals.items()
+        ])
+    db.session.commit()
+
+
+class UpdateOffset(db.Model):
+    """
+    the next update id to fetch from a polled update source, like
+    'telegram:<bot id>', committed with the updates before it.
+    """
+    name = db.Column(db.String(80), primary_key=True)
+    next_update_id = db.Column(db.Integer, nullable=False)
+
+
+def get_update_offset(name):
+    offset = UpdateOffset.query.get(name)
+    return 0 if offset is None else offset.next_update_id
+
+
+def set_update_offset(name, next_update_id):
+    db.session.merge(UpdateOffset(name=name, next_update_id=next_update_id))
+
+
 def _latest_record_id():
     return db.session.query(func.max(WorkOutRecord.id)).scalar() or 0
 
 
 class ChallengeProgress(db.Model):
+    __table_args__ = (
+        db.Index('ix_challenge_progress_user_id_challenge_id_finished',
+                 'user_id', 'challenge_id', 'finished'),
+        db.Index('ix_challenge_progress_user_id_finished',
+                 'user_id', 'finished'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     achieved = db.Column(db.Integer, nullable=False, default=0)
     start_record_id = db.Column(db.Integer, nullable=True, default=_latest_record_id)
     latest_record_id = db.Column(db.Integer, nullable=True, default=_latest_record_id)
+    latest_record_ts = db.Column(db.DateTime, nullable=True)
     memo = db.Column(db.String(2048), nullable=True)
     finished = db.Column(db.Boolean, default=False)
 
@@ -225,21 +685,77 @@ def get_user(name):
 
 
 def add_record(user_or_name, workout_name, groups):
+    """
+    check in run length `groups` of (times, count) as one record.
+    """
+    records, workouts = add_records(user_or_name, [(workout_name, groups)])
+    return records, workouts[0]
+
+
+def add_records(user_or_name, check_ins):
+    """
+    check in a batch of (workout name, groups) as one record each, return
+    the new records and the workouts of `check_ins`.
+
+    a JsError is raised before anything is added if a workout is unknown.
+    """
     if isinstance(user_or_name, str):
         user, _ = get_or_create_user(user_or_name)
     else:
         user = user_or_name
-    workout = Workout.query.filter_by(name=workout_name).first()
-    if workout is None:
-        raise JsError(f'项目: {workout_name} 不存在')
+    catalog = workout_catalog()
+    workouts = []
+    for workout_name, _ in check_ins:
+        workout = catalog.find(workout_name)
+        if workout is None:
+            raise JsError(f'项目: {workout_name} 不存在')
+        workouts.append(workout)
     dt = datetime.datetime.utcnow()
     records = []
-    for times in groups:
-        record = WorkOutRecord(user_id=user.id, workout_id=workout.id, times=times, ts=dt)
-        records.append(record)
+    for workout, (_, groups) in zip(workouts, check_ins):
+        if len(groups) == 0:
+            continue
+        times = sum(times * count for times, count in groups)
+        record = WorkOutRecord(user_id=user.id, workout_id=workout.id, ts=dt,
+                               times=times, sets=format_groups(groups),
+                               tonnage=times * workout_weight(workout.name))
         db.session.add(record)
+        records.append((record, workout, sum(count for _, count in groups)))
+    if not records:
+        return [], workouts
+    _update_leaderboard(user, [(w, r.times) for r, w, _ in records], dt)
+    _update_daily_rollup(user, [(r, sets) for r, _, sets in records], dt)
     db.session.flush()
-    return records, workout
+    return [r for r, _, _ in records], workouts
+
+
+def record_summary(user, since):
+    """
+    records of the user after `since` by day and workout, with the sets
+    merged by times, as [(date, workout_id, [(times, count), ...]), ...].
+
+    days come latest first, workouts of a day latest checked in first, and
+    the sets of a workout in the order they were first checked in.
+    """
+    date = func.date(WorkOutRecord.ts)
+    rows = db.session.query(date, WorkOutRecord.workout_id, WorkOutRecord.sets,
+                            func.count(WorkOutRecord.id),
+                            func.min(WorkOutRecord.id), func.max(WorkOutRecord.id))\
+        .filter(WorkOutRecord.user_id == user.id, WorkOutRecord.ts > since)\
+        .group_by(date, WorkOutRecord.workout_id, WorkOutRecord.sets)
+    groups = {}
+    for day, workout_id, sets, count, first_id, last_id in rows:
+        groups.setdefault((str(day), workout_id), []).append((first_id, last_id, sets, count))
+    ordered = sorted(groups.items(), reverse=True,
+                     key=lambda item: (item[0][0], max(s[1] for s in item[1])))
+    summary = []
+    for (day, workout_id), check_ins in ordered:
+        merged = {}
+        for _, _, sets, count in sorted(check_ins):
+            for times, times_count in parse_groups(sets):
+                merged[times] = merged.get(times, 0) + times_count * count
+        summary.append((day, workout_id, list(merged.items())))
+    return summary
 
 
 def add_command(user_name, command_text):
@@ -248,6 +764,18 @@ def add_command(user_name, command_text):
     db.session.commit()
 
 
+def active_challenge_progresses(user):
+    """
+    unfinished challenge progresses of the user, with their challenges
+    loaded in the same statement.
+    """
+    return ChallengeProgress.query.with_parent(user)\
+        .filter(ChallengeProgress.finished.isnot(True))\
+        .options(db.joinedload(ChallengeProgress.challenge))\
+        .order_by(ChallengeProgress.id)\
+        .all()
+
+
 def add_challenge(name, total):
     challenge = Challenge(name=name, total=total)
     db.session.add(challenge)
@@ -275,7 +803,7 @@ def add_challenge_progress(user_or_name, challenge_or_name, **kwargs):
         raise JsError(f"{user_or_name} 已经参加了挑战 {challenge_or_name}")
     progress = ChallengeProgress(user=user, challenge=challenge, **kwargs)
     db.session.add(progress)
-    db.session.commit()
+    commit()
     return progress
 
 
@@ -299,6 +827,27 @@ def _with_db(f):
     return wrapped
 
 
+def test_sqlite_pragmas():
+    import os
+    import tempfile
+
+    import flask
+    with tempfile.TemporaryDirectory() as tmp:
+        app = flask.Flask("js")
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp, 'js.db')
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.config['SQLITE_PRAGMAS'] = {'busy_timeout': 1000}
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True}
+        init_app(app)
+        engine = db.get_engine(app)
+        assert engine.pool._pre_ping
+        with engine.connect() as conn:
+            pragmas = [conn.execute(f'PRAGMA {name}').scalar()
+                       for name in ('journal_mode', 'synchronous', 'busy_timeout')]
+        engine.dispose()
+    assert pragmas == ['wal', 1, 1000]
+
+
 @_with_db
 def test_add_user():
     assert User.query.count() == 0
@@ -317,17 +866,74 @@ def test_add_user():
         assert user.name in ['user1', 'user2']
 
 
+@_with_db
+def test_seed_builtins():
+    Workout.create_builtin_workouts()
+    Challenge.create_builtin_challenges()
+    db.session.delete(Workout.query.filter_by(name='burpee').one())
+    db.session.commit()
+    Workout.create_builtin_workouts()
+    Challenge.create_builtin_challenges()
+
+    assert sorted(w.name for w in Workout.query) == \
+        sorted(w['name'] for w in BUILTIN_WORKOUTS)
+    assert Challenge.query.count() == len(BUILTIN_CHALLENGES)
+    assert Challenge.query.filter_by(name='kbsw-10000').one().closed is False
+    assert workout_catalog().find('burpee').description == '波比跳'
+
+
+@_with_db
+def test_batch_transaction():
+    add_challenge('kbsw-10000', 10000)
+    with batch_transaction():
+        add_challenge_progress('user', 'kbsw-10000')
+        set_update_offset('telegram:1', 10)
+    db.session.rollback()
+    assert ChallengeProgress.query.count() == 0
+    assert get_update_offset('telegram:1') == 0
+
+    with batch_transaction():
+        add_challenge_progress('user', 'kbsw-10000')
+        set_update_offset('telegram:1', 10)
+    set_update_offset('telegram:1', 12)
+    db.session.commit()
+    assert ChallengeProgress.query.count() == 1
+    assert get_update_offset('telegram:1') == 12
+
+
 @_with_db
 def test_add_record():
     Workout.create_builtin_workouts()
-    add_record('user', 'kbsw-16', [50, 50, 50])
+    add_record('user', 'kbsw-16', [(50, 3), (40, 1)])
 
     user = User.query.filter_by(name='user').first()
     assert user is not None
-    assert len(user.records) == 3
+    assert len(user.records) == 1
     workout = Workout.query.filter_by(name='kbsw-16').first()
     assert workout is not None
-    assert len(workout.records) == 3
+    assert len(workout.records) == 1
+    record = workout.records[0]
+    assert (record.times, record.sets, record.tonnage) == (190, '50x3,40', 190 * 16)
+    assert record.groups == [(50, 3), (40, 1)]
+
+
+@_with_db
+def test_add_records():
+    Workout.create_builtin_workouts()
+    try:
+        add_records('user', [('kbsw-16', [(50, 1)]), ('nosuchworkout', [(10, 1)])])
+    except JsError:
+        pass
+    assert WorkOutRecord.query.count() == 0
+
+    records, workouts = add_records(
+        'user', [('kbsw-16', [(50, 2)]), ('pullup', []), ('kbsw-16', [(20, 1)])])
+    assert [w.name for w in workouts] == ['kbsw-16', 'pullup', 'kbsw-16']
+    assert [r.times for r in records] == [100, 20]
+    rollup = DailyRollup.query.one()
+    assert (rollup.sets, rollup.times) == (3, 120)
+    entry = LeaderboardEntry.query.filter_by(bucket='day', family='kbsw').one()
+    assert entry.times == 120
 
 
 @_with_db
@@ -344,16 +950,216 @@ def test_add_command():
 def test_add_challenge_progress():
     Workout.create_builtin_workouts()
     challenge = add_challenge('kbsw-10000', 10000)
-    add_record('user', 'kbsw-16', [50, 50, 50])
+    add_record('user', 'kbsw-16', [(50, 3)])
     progress = add_challenge_progress('user', 'kbsw-10000')
 
     assert progress.user.name == "user"
     assert progress.challenge.name == challenge.name
-    assert progress.start_record_id == 3
-    assert progress.latest_record_id == 3
+    assert progress.start_record_id == 1
+    assert progress.latest_record_id == 1
     assert progress.achieved == 0
 
 
+@_with_db
+def test_active_challenge_progresses():
+    add_challenge('kbsw-10000', 10000)
+    add_challenge('pullup-500', 500)
+    add_challenge_progress('user', 'kbsw-10000')
+    finished = add_challenge_progress('user', 'pullup-500')
+    finished.finished = True
+    add_challenge_progress('user', 'pullup-500')
+    add_challenge_progress('other', 'pullup-500')
+    user = get_user('user')
+
+    progresses = active_challenge_progresses(user)
+    assert [(p.id, p.challenge.name) for p in progresses] == \
+        [(1, 'kbsw-10000'), (3, 'pullup-500')]
+
+
+@_with_db
+def test_workout_catalog():
+    Workout.create_builtin_workouts()
+    catalog = workout_catalog()
+    kbsw = catalog.find('kbsw-16')
+    assert kbsw.description == '16公斤壶铃摆荡'
+    assert catalog.get(kbsw.id) is kbsw
+    families = dict(catalog.families)
+    assert [w.name for w in families['pullup']] == ['pullup', 'pullup-aid']
+
+    # unknown names check the table at most once every miss_interval
+    statements = []
+
+    def on_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', on_execute)
+    for _ in range(10):
+        assert catalog.find('no-such-workout') is None
+    event.remove(db.engine, 'before_cursor_execute', on_execute)
+    assert len(statements) == 1
+
+    # added by another process: found by reloading on a miss
+    db.session.add(Workout(name='muscleup', description='双力臂'))
+    db.session.commit()
+    catalog.missed_at -= catalog.miss_interval
+    assert catalog.find('muscleup').description == '双力臂'
+    assert workout_catalog() is catalog
+
+
+@_with_db
+def test_record_summary():
+    Workout.create_builtin_workouts()
+    add_record('user', 'kbsw-16', [(50, 1), (40, 3)])
+    add_record('user', 'pullup', [(10, 2)])
+    add_record('user', 'kbsw-16', [(40, 1), (30, 1)])
+    add_record('other', 'pullup', [(5, 1)])
+    add_record('user', 'kbsw-16', [(40, 1)])
+    for record in WorkOutRecord.query.filter(WorkOutRecord.id.in_([1, 5])):
+        record.ts -= datetime.timedelta(days=1)
+    user = get_user('user')
+    kbsw = workout_catalog().find('kbsw-16').id
+    pullup = workout_catalog().find('pullup').id
+    today = datetime.datetime.utcnow().date()
+
+    summary = record_summary(user, datetime.datetime.utcnow() - datetime.timedelta(days=3))
+    assert summary == [
+        (today.isoformat(), kbsw, [(40, 1), (30, 1)]),
+        (today.isoformat(), pullup, [(10, 2)]),
+        ((today - datetime.timedelta(days=1)).isoformat(), kbsw, [(50, 1), (40, 4)]),
+    ]
+    assert record_summary(user, datetime.datetime.utcnow()) == []
+
+
+@_with_db
+def test_daily_rollup():
+    Workout.create_builtin_workouts()
+    add_record('user', 'kbsw-16', [(50, 1), (40, 2)])
+    add_record('user', 'pullup', [(10, 2)])
+    add_record('user', 'kbsw-16', [(20, 1)])
+    add_record('other', 'kbsw-16', [(5, 1)])
+    user = get_user('user')
+    kbsw = workout_catalog().find('kbsw-16').id
+    pullup = workout_catalog().find('pullup').id
+    today = datetime.datetime.utcnow().date()
+
+    expected = [(today.isoformat(), pullup, 2, 20), (today.isoformat(), kbsw, 4, 150)]
+    assert daily_rollup_summary(user, today) == expected
+    rollup = DailyRollup.query.filter_by(user_id=user.id, workout_id=kbsw).one()
+    assert rollup.tonnage == 150 * 16
+    assert daily_rollup_summary(user, today + datetime.timedelta(days=1)) == []
+
+    rebuild_daily_rollup()
+    assert sorted(daily_rollup_summary(user, today)) == sorted(expected)
+
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=40)
+    for _ in range(2):
+        db.session.add(WorkOutRecord(user_id=user.id, workout_id=kbsw, ts=old,
+                                     times=90, sets='30x2,30', tonnage=90 * 16))
+    rebuild_daily_rollup()
+    assert sorted(daily_rollup_summary(user, old.date())) == \
+        sorted(expected + [(old.date().isoformat(), kbsw, 6, 180)])
+
+
+@_with_db
+def test_leaderboard():
+    Workout.create_builtin_workouts()
+    add_record('user1', 'kbsw-16', [(50, 2)])
+    add_record('user1', 'kbsw-24', [(20, 1)])
+    add_record('user2', 'kbsw-16', [(100, 2)])
+    add_record('user2', 'pullup', [(10, 1)])
+    add_record('user3', 'pullup', [(30, 1)])
+    user2 = get_user('user2')
+    user2.invisible = True
+
+    assert LeaderboardEntry.query.filter_by(user_id=1).count() == 8
+    entry = LeaderboardEntry.query.filter_by(user_id=1, bucket='week', family='kbsw').one()
+    assert entry.times == 120
+
+    top = [(u.name, times) for u, times in leaderboard('week', 'kbsw')]
+    assert top == [('user1', 120)]
+    top = [(u.name, times) for u, times in leaderboard('day')]
+    assert top == [('user1', 120), ('user3', 30)]
+
+    user2.invisible = False
+    expected = [(u.name, times) for u, times in leaderboard('all', limit=2)]
+    assert expected == [('user2', 210), ('user1', 120)]
+    rebuild_leaderboard()
+    assert [(u.name, times) for u, times in leaderboard('all', limit=2)] == expected
+
+    def entries():
+        return sorted((e.user_id, e.bucket, e.bucket_start, e.family, e.times)
+                      for e in LeaderboardEntry.query)
+    before = entries()
+    rebuild_leaderboard()
+    assert entries() == before
+
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=40)
+    kbsw = workout_catalog().find('kbsw-16')
+    db.session.add(WorkOutRecord(user_id=1, workout_id=kbsw.id, ts=old, times=30, sets='30'))
+    rebuild_leaderboard()
+    entry = LeaderboardEntry.query.filter_by(user_id=1, bucket='month', family='kbsw',
+                                             bucket_start=bucket_start('month', old)).one()
+    assert entry.times == 30
+    entry = LeaderboardEntry.query.filter_by(user_id=1, bucket='all', family='kbsw').one()
+    assert entry.times == 150
+
+
+@_with_db
+def test_concurrent_first_check_in():
+    Workout.create_builtin_workouts()
+    user, _ = get_or_create_user('user')
+    kbsw = workout_catalog().find('kbsw-16')
+    now = datetime.datetime.utcnow()
+    db.session.commit()
+
+    def insert_concurrently(table, **values):
+        # a row another check-in committed after the update looked it up
+        def insert(conn, name):
+            conn.execute(table.insert(), user_id=user.id, **values)
+        event.listen(db.engine, 'savepoint', insert, once=True)
+
+    insert_concurrently(LeaderboardEntry.__table__, bucket='day', times=5,
+                        bucket_start=bucket_start('day', now),
+                        family=LEADERBOARD_ALL_FAMILIES)
+    _update_leaderboard(user, [(kbsw, 100)], now)
+    record = WorkOutRecord(user_id=user.id, workout_id=kbsw.id, ts=now,
+                           times=100, sets='50x2', tonnage=1600)
+    db.session.add(record)
+    insert_concurrently(DailyRollup.__table__, date=now.date(), workout_id=kbsw.id,
+                        sets=1, times=5, tonnage=80)
+    _update_daily_rollup(user, [(record, 2)], now)
+    db.session.commit()
+
+    rollup = DailyRollup.query.one()
+    assert (rollup.sets, rollup.times, rollup.tonnage) == (3, 105, 1680)
+    entry = LeaderboardEntry.query.filter_by(bucket='day', family=LEADERBOARD_ALL_FAMILIES).one()
+    assert entry.times == 105
+    assert LeaderboardEntry.query.count() == 8
+
+
+@_with_db
+def test_user_badges():
+    user, _ = get_or_create_user('user')
+    assert repr(user) == 'user'
+    user.set_finished_challenges(3)
+    db.session.commit()
+    assert repr(user) == 'user🏋③'
+
+    # memorized during the request, no query even though the user expired
+    User.query.filter_by(id=user.id).update({'finished_challenges': 1})
+    db.session.expire(user)
+    assert repr(user) == 'user🏋③'
+    user.set_finished_challenges(1)
+    assert repr(user) == 'user🏋'
+
+    # a concurrent check-in finished more challenges since the user was loaded
+    assert user.finished_challenges == 1
+    User.query.filter_by(id=user.id).update({'finished_challenges': 5},
+                                             synchronize_session=False)
+    user.add_finished_challenge()
+    user.add_finished_challenge()
+    assert repr(user) == 'user🏋⑦'
+
+
 if __name__ == '__main__':
     from .app import create_app
     app = create_app()
@@ -0,0 +1,347 @@
+"""
+background delivery of outbound bot api calls.
+
+replies are put into a bounded queue and sent by worker threads sharing one
+keep-alive http session, failed calls are retried with exponential backoff
+and a circuit breaker sheds load while the api is down.
+"""
+import collections
+import logging
+import queue
+import threading
+import time
+
+import requests
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failure_threshold` consecutive failures,
+    open -> half-open after `reset_timeout` seconds, where a single trial
+    call decides whether to close again or re-open.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+            self.trial_running = False
+
+
+class _Stats:
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.latencies = collections.deque(maxlen=window)
+
+    def incr(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def observe(self, latency):
+        with self.lock:
+            self.counters['sent'] += 1
+            self.latencies.append(latency)
+
+    def snapshot(self):
+        with self.lock:
+            result = dict(self.counters)
+            latencies = sorted(self.latencies)
+        for name in ('sent', 'failed', 'dropped', 'shed', 'retried'):
+            result.setdefault(name, 0)
+        if latencies:
+            result['latency_p50'] = latencies[len(latencies) // 2]
+            result['latency_p95'] = latencies[int(len(latencies) * .95)]
+            result['latency_max'] = latencies[-1]
+        return result
+
+
+class _SenderBase:
+    """
+    the circuit breaker, retry policy and stats shared by `OutboundSender`
+    and the asyncio sender of `aio`, which only differ in how they queue and
+    post the calls.
+    """
+
+    def __init__(self, api_url, timeout, max_retries, backoff, breaker):
+        self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.stats = _Stats()
+
+    def report(self):
+        result = self.stats.snapshot()
+        result['queue_depth'] = self._queue_depth()
+        result['circuit'] = self.breaker.state
+        return result
+
+    def _queue_depth(self):
+        raise NotImplementedError
+
+    def _is_retryable(self, error):
+        raise NotImplementedError
+
+    def _url(self, token, method):
+        return f'{self.api_url}/bot{token}/{method}'
+
+    def _admit(self, method):
+        """
+        False if a call is shed on submit because the api circuit is open.
+        """
+        if self.breaker.state == CircuitBreaker.OPEN:
+            self.stats.incr('shed')
+            logging.warning('api circuit open, shed %s call', method)
+            return False
+        return True
+
+    def _allow_attempt(self, method):
+        if not self.breaker.allow():
+            self.stats.incr('shed')
+            logging.warning('api circuit open, shed %s call', method)
+            return False
+        return True
+
+    def _succeeded(self, enqueued_at):
+        self.breaker.record_success()
+        self.stats.observe(time.monotonic() - enqueued_at)
+
+    def _failed(self, error, method, attempt):
+        """
+        record a failed attempt, in the except block handling `error`.
+        return the seconds to wait before the next attempt, or None to give
+        up.
+        """
+        if not self._is_retryable(error):
+            # the api rejected the call itself, it is still up
+            self.breaker.record_success()
+            self.stats.incr('failed')
+            logging.exception('%s call rejected', method)
+            return None
+        self.breaker.record_failure()
+        if attempt == self.max_retries:
+            self.stats.incr('failed')
+            logging.exception('%s call failed after %s attempts', method, attempt + 1)
+            return None
+        self.stats.incr('retried')
+        return self.backoff * 2 ** attempt
+
+
+class OutboundSender(_SenderBase):
+    """
+    deliver bot api method calls in background threads.
+
+        sender = OutboundSender('https://api.telegram.org')
+        sender.start()
+        sender.submit(token, 'sendMessage', {'chat_id': 1, 'text': 'hi'})
+    """
+
+    def __init__(self, api_url, workers=4, queue_size=1000, timeout=2.,
+                 max_retries=3, backoff=.5, breaker=None):
+        super().__init__(api_url, timeout, max_retries, backoff, breaker)
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers - len(self.threads)):
+            thread = threading.Thread(target=self._run, daemon=True,
+                                      name=f'outbound-{len(self.threads)}')
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, timeout=5.):
+        """
+        wait for queued calls to be delivered, then stop the workers.
+        """
+        deadline = time.monotonic() + timeout
+        for _ in self.threads:
+            try:
+                self.queue.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        self.threads = [t for t in self.threads if t.is_alive()]
+
+    def submit(self, token, method, payload):
+        """
+        enqueue a bot api call, return False if it is dropped.
+        """
+        if not self._admit(method):
+            return False
+        try:
+            self.queue.put_nowait((token, method, payload, time.monotonic()))
+        except queue.Full:
+            self.stats.incr('dropped')
+            logging.warning('outbound queue full, drop %s call', method)
+            return False
+        return True
+
+    def _queue_depth(self):
+        return self.queue.qsize()
+
+    def _is_retryable(self, error):
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            status = error.response.status_code
+            return status == 429 or status >= 500
+        return isinstance(error, requests.RequestException)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._deliver(*item)
+            finally:
+                self.queue.task_done()
+
+    def _deliver(self, token, method, payload, enqueued_at):
+        for attempt in range(self.max_retries + 1):
+            if not self._allow_attempt(method):
+                return
+            try:
+                self.session\
+                    .post(self._url(token, method), json=payload, timeout=self.timeout)\
+                    .raise_for_status()
+            except Exception as error:
+                delay = self._failed(error, method, attempt)
+                if delay is None:
+                    return
+                time.sleep(delay)
+            else:
+                self._succeeded(enqueued_at)
+                return
+
+
+class _StubApi:
+    """
+    local stand-in for the bot api, answering with queued status codes and
+    queued results of each method.
+    """
+
+    def __init__(self, statuses=(), results=None):
+        import http.server
+        import json
+        import socketserver
+
+        stub = self
+        self.calls = []
+        self.statuses = list(statuses)
+        self.results = results or {}
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                stub.calls.append((self.path, json.loads(self.rfile.read(length))))
+                status = stub.statuses.pop(0) if stub.statuses else 200
+                results = stub.results.get(self.path.rsplit('/', 1)[-1])
+                result = results.pop(0) if results else True
+                body = json.dumps({'ok': status == 200, 'result': result}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def test_sender_delivers_and_retries():
+    api = _StubApi(statuses=[500, 502])
+    sender = OutboundSender(api.url, workers=1, backoff=.01).start()
+    try:
+        assert sender.submit('token', 'sendMessage', {'chat_id': 1, 'text': 'hi'})
+        sender.stop()
+    finally:
+        api.close()
+    assert api.calls == [('/bottoken/sendMessage', {'chat_id': 1, 'text': 'hi'})] * 3
+    report = sender.report()
+    assert report['sent'] == 1
+    assert report['retried'] == 2
+    assert report['queue_depth'] == 0
+    assert report['circuit'] == CircuitBreaker.CLOSED
+
+
+def test_sender_sheds_load_when_circuit_open():
+    api = _StubApi(statuses=[500] * 3)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    sender = OutboundSender(api.url, workers=1, max_retries=1, backoff=.01,
+                            breaker=breaker).start()
+    try:
+        sender.submit('token', 'sendMessage', {'text': '1'})
+        sender.queue.join()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not sender.submit('token', 'sendMessage', {'text': '2'})
+        breaker.opened_at -= 60
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert sender.submit('token', 'sendMessage', {'text': '3'})
+        sender.stop()
+    finally:
+        api.close()
+    assert len(api.calls) == 3
+    report = sender.report()
+    assert report['failed'] == 1
+    assert report['shed'] == 2
+    assert breaker.state == CircuitBreaker.OPEN
@@ -4,38 +4,44 @@ class ParseError(Exception):
         self.text = text
 
 
-def parse_records(text):
-    """parse workout records
+# upper bounds of a single check-in, see `parse_record_groups`
+MAX_SETS = 100
+MAX_TIMES = 10000
+
+
+def parse_record_groups(text, max_sets=MAX_SETS, max_times=MAX_TIMES):
+    """parse workout records as run length groups of (times, count)
 
         '' -> []
-        50 -> [50]
-        50x5 -> [50, 50, 50, 50, 50]
-        50*5 -> [50, 50, 50, 50, 50]
-        50,40,40,40,40 -> [50, 40, 40, 40, 40]
-        50,40x4 -> [50, 40, 40, 40, 40]
-        50,40*4 -> [50, 40, 40, 40, 40]
+        50 -> [(50, 1)]
+        50x5 -> [(50, 5)]
+        50*5 -> [(50, 5)]
+        50,40,40,40,40 -> [(50, 1), (40, 4)]
+        50,40x4 -> [(50, 1), (40, 4)]
+        50,40*4 -> [(50, 1), (40, 4)]
+
+    a ParseError is raised when the records add up to more than `max_sets`
+    sets or `max_times` times.
      """
 
     def multi_parser(op, content):
         parts = content.split(op)
         if not (len(parts) == 2 and all(part.isdecimal() for part in parts)):
             raise ParseError(content)
-        times = int(parts[0])
-        groups = int(parts[1])
-        return [times] * groups
+        return int(parts[0]), int(parts[1])
 
     def sub_parser(content):
         """
-        '' -> []
-        50 -> [50]
-        50x5 -> [50, 50, 50, 50, 50]
-        50*5 -> [50, 50, 50, 50, 50]
+        '' -> None
+        50 -> (50, 1)
+        50x5 -> (50, 5)
+        50*5 -> (50, 5)
         """
         content = content.strip()
         if content == '':
-            return []
+            return None
         if content.isdecimal():
-            return [int(content)]
+            return int(content), 1
 
         for op in '*x':
             if op in content:
@@ -45,35 +51,130 @@ def parse_records(text):
     allowed_characters = '*x,0123456789'
     if not all(c in allowed_characters for c in text):
         raise ParseError(text)
-    result = []
+    groups = []
+    sets = total = 0
     for sub_text in text.split(','):
-        result.extend(sub_parser(sub_text))
-    return result
+        group = sub_parser(sub_text)
+        if group is None or group[1] == 0:
+            continue
+        times, count = group
+        sets += count
+        total += times * count
+        if max_sets is not None and sets > max_sets:
+            raise ParseError(f'{text} (最多{max_sets}组)')
+        if max_times is not None and total > max_times:
+            raise ParseError(f'{text} (最多{max_times}次)')
+        if groups and groups[-1][0] == times:
+            groups[-1] = (times, groups[-1][1] + count)
+        else:
+            groups.append((times, count))
+    return groups
+
+
+def parse_records(text):
+    """parse workout records
+
+        '' -> []
+        50 -> [50]
+        50x5 -> [50, 50, 50, 50, 50]
+        50*5 -> [50, 50, 50, 50, 50]
+        50,40,40,40,40 -> [50, 40, 40, 40, 40]
+        50,40x4 -> [50, 40, 40, 40, 40]
+        50,40*4 -> [50, 40, 40, 40, 40]
+     """
+    return [times for times, count in parse_record_groups(text)
+            for _ in range(count)]
 
 
-def parse_command_with_text_arguments(text: str):
+class CommandLine:
+    """a command line tokenized once, handed to the command processors.
+
+  'show ycqian 7' -> CommandLine(name='show', args=['ycqian', '7'])
+    """
+    __slots__ = ('text', 'name', 'args')
+
+    def __init__(self, text: str):
+        parts = text.split()
+        if len(parts) == 0:
+            raise ParseError(text)
+        self.text = text
+        self.name = parts[0]
+        self.args = parts[1:]
+
+    def __repr__(self):
+        return f'CommandLine(name={self.name!r}, args={self.args!r})'
+
+
+def split_command_lines(text):
+    """split a message into its non-empty command lines
+
+  'kbsw-16 50x5\n\n pullup 10\n' -> ['kbsw-16 50x5', 'pullup 10']
+    """
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def parse_command_line(text):
+    if isinstance(text, CommandLine):
+        return text
+    return CommandLine(text)
+
+
+def format_groups(groups):
+    """format run length groups in the syntax of `parse_records`
+
+        [(50, 2), (40, 1)] -> '50x2,40'
+    """
+    return ','.join(f'{times}' if count == 1 else f'{times}x{count}'
+                    for times, count in groups)
+
+
+def parse_groups(text):
+    """parse run length groups formatted by `format_groups`
+
+        '50x2,40' -> [(50, 2), (40, 1)]
+    """
+    groups = []
+    for part in text.split(','):
+        times, _, count = part.partition('x')
+        groups.append((int(times), int(count or 1)))
+    return groups
+
+
+def parse_command_with_text_arguments(text):
     """parse command name and text arguments from command line.
 
   'show' -> ('show', [])
   'show ycqian zlji' -> ('show', ['ycqian', 'zlji'])
   'challenge pullup -> ('challenge', ['pullup'])
     """
-    parts = text.split()
-    cmd = parts[0]
-    args = parts[1:]
-    return cmd, args
+    line = parse_command_line(text)
+    return line.name, line.args
 
 
-def parse_command_with_records(text: str):
+def parse_command_with_records(text):
     """parse command name and records from command line.
 
   'kbsw-12 50' -> ('kbsw-12', [50])
   'kbsw-12 50x3' -> ('kbsw-12', [50, 50, 50])
   'kbsw-12 50x3,60' -> ('kbsw-12', [50, 50, 50, 60])
     """
+    line = parse_command_line(text)
+    if len(line.args) != 1:
+        raise ParseError(line.text)
+    return line.name, parse_records(line.args[0])
+
+
+def parse_command_with_record_groups(text, max_sets=MAX_SETS, max_times=MAX_TIMES):
+    """parse command name and run length groups of records from command line.
 
-    cmd, record_parts = text.split()
-    return cmd, parse_records(record_parts)
+  'kbsw-12 50' -> ('kbsw-12', [(50, 1)])
+  'kbsw-12 50x3' -> ('kbsw-12', [(50, 3)])
+  'kbsw-12 50x3,60' -> ('kbsw-12', [(50, 3), (60, 1)])
+    """
+    line = parse_command_line(text)
+    if len(line.args) != 1:
+        raise ParseError(line.text)
+    return line.name, parse_record_groups(line.args[0], max_sets, max_times)
 
 
 def test_parse_records():
@@ -95,3 +196,40 @@ def test_parse_command_with_records():
     assert parse_command_with_records('kbsw-12 50') == ('kbsw-12', [50])
     assert parse_command_with_records('kbsw-12 50x3') == ('kbsw-12', [50, 50, 50])
     assert parse_command_with_records('kbsw-12 50x3,60') == ('kbsw-12', [50, 50, 50, 60])
+
+
+def test_parse_command_line():
+    line = parse_command_line(' show  ycqian 7 ')
+    assert (line.name, line.args) == ('show', ['ycqian', '7'])
+    assert parse_command_line(line) is line
+    assert parse_command_with_text_arguments(line) == ('show', ['ycqian', '7'])
+    assert parse_command_with_records(CommandLine('kbsw-12 50x2')) == ('kbsw-12', [50, 50])
+
+
+def test_split_command_lines():
+    assert split_command_lines('show') == ['show']
+    assert split_command_lines('kbsw-16 50x5; pullup 10') == ['kbsw-16 50x5; pullup 10']
+    assert split_command_lines('kbsw-16 50x5\n\n pullup 10 \nshow\n') == \
+        ['kbsw-16 50x5', 'pullup 10', 'show']
+    assert split_command_lines(' \n') == []
+
+
+def test_run_length_groups():
+    assert format_groups([(50, 2), (40, 1), (50, 1)]) == '50x2,40,50'
+    assert parse_groups('50x2,40,50') == [(50, 2), (40, 1), (50, 1)]
+
+
+def test_parse_record_groups():
+    assert parse_record_groups('') == []
+    assert parse_record_groups('50x5') == [(50, 5)]
+    assert parse_record_groups('50,40,40*3,30x0') == [(50, 1), (40, 4)]
+    assert parse_command_with_record_groups('kbsw-12 50x3,60') == \
+        ('kbsw-12', [(50, 3), (60, 1)])
+    for text in ('50x1000000', '1000000', '1x101'):
+        try:
+            parse_record_groups(text)
+        except ParseError as error:
+            assert error.text.startswith(text)
+        else:
+            assert False, text
+    assert parse_record_groups('1x101', max_sets=None) == [(1, 101)]
@@ -0,0 +1,227 @@
+"""
+telegram long polling worker, an alternative to the `/bot/<token>` webhook.
+
+updates are fetched with getUpdates in batches, the commands of a batch run
+in one database transaction which also stores the offset of the next
+update, and the replies are sent by the outbound sender after the commit.
+a restart resumes from the stored offset, so an update is neither lost nor
+processed twice.
+
+    JS_TELEGRAM_TOKEN=... python -m js.poller
+"""
+import argparse
+import logging
+import threading
+
+import requests
+
+from . import models as m
+from .main import app as flask_app
+from .main import flush_command_log, process_telegram, split_message
+from .outbound import OutboundSender
+
+
+class TelegramPoller:
+    def __init__(self, app, token, sender, limit=100, timeout=30, backoff=1.):
+        self.app = app
+        self.token = token
+        self.sender = sender
+        self.limit = limit
+        self.timeout = timeout
+        self.backoff = backoff
+        self.api_url = app.config['TELEGRAM_API_URL'].rstrip('/')
+        # the bot id part of the token, not the secret
+        self.offset_name = 'telegram:' + token.split(':', 1)[0]
+        self.session = requests.Session()
+        self.stopped = threading.Event()
+
+    def fetch(self, offset):
+        response = self.session.post(
+            f'{self.api_url}/bot{self.token}/getUpdates',
+            json={'offset': offset, 'limit': self.limit, 'timeout': self.timeout,
+                  'allowed_updates': ['message']},
+            timeout=self.timeout + 10)
+        response.raise_for_status()
+        return response.json()['result']
+
+    def process_batch(self, updates):
+        """
+        run the commands of `updates` and store the next offset in one
+        transaction, return the replies to send.
+
+        an update whose command raises is skipped: the batch is rolled back
+        and run again without it, in a new app context so that nothing the
+        failed attempt left in `g` is reused and its commands are not logged.
+        """
+        skipped = set()
+        while True:
+            with self.app.app_context():
+                replies = []
+                failed = None
+                with m.batch_transaction():
+                    for update in updates:
+                        if update['update_id'] in skipped:
+                            continue
+                        try:
+                            response = process_telegram(update)
+                        except Exception:
+                            logging.exception('update %s failed', update['update_id'])
+                            failed = update['update_id']
+                            break
+                        if response is not None:
+                            replies.extend(split_message(response))
+                if failed is None:
+                    m.set_update_offset(self.offset_name, updates[-1]['update_id'] + 1)
+                    m.db.session.commit()
+                    flush_command_log()
+                    return replies
+                m.db.session.rollback()
+            skipped.add(failed)
+
+    def poll_once(self):
+        """
+        fetch and process one batch of updates, return the number processed.
+        """
+        with self.app.app_context():
+            offset = m.get_update_offset(self.offset_name)
+        # getUpdates returns the updates after `offset` again if the last
+        # call did not reach telegram, skip any the database already has
+        updates = [u for u in self.fetch(offset) if u['update_id'] >= offset]
+        if not updates:
+            return 0
+        for reply in self.process_batch(updates):
+            self.sender.submit(self.token, 'sendMessage', reply)
+        return len(updates)
+
+    def run(self):
+        logging.info('polling updates of %s', self.offset_name)
+        while not self.stopped.is_set():
+            try:
+                self.poll_once()
+            except Exception:
+                logging.exception('failed to poll updates')
+                self.stopped.wait(self.backoff)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='process telegram updates by long polling')
+    parser.add_argument('--token', default=flask_app.config['TELEGRAM_TOKEN'],
+                        help='bot token, JS_TELEGRAM_TOKEN by default')
+    args = parser.parse_args()
+    if not args.token:
+        parser.error('a bot token is required')
+    logging.basicConfig(level=logging.INFO)
+    config = flask_app.config
+    sender = OutboundSender(config['TELEGRAM_API_URL'],
+                            workers=config['TELEGRAM_SENDER_WORKERS'],
+                            queue_size=config['TELEGRAM_SENDER_QUEUE_SIZE']).start()
+    poller = TelegramPoller(flask_app, args.token, sender,
+                            limit=config['TELEGRAM_POLL_LIMIT'],
+                            timeout=config['TELEGRAM_POLL_TIMEOUT'])
+    try:
+        poller.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sender.stop()
+
+
+def test_poller_batches_and_checkpoints():
+    import copy
+
+    from .app import _create_app_with_env
+    from .outbound import _StubApi
+    from .samples import telegram_request_sample
+
+    def update(update_id, text, user_id=1):
+        result = copy.deepcopy(telegram_request_sample)
+        result['update_id'] = update_id
+        result['message'].update(message_id=update_id, text=text)
+        result['message']['from']['id'] = user_id
+        return result
+
+    broken = update(3, '/kbsw_16 10')
+    del broken['message']['from']
+    batch = [update(1, '/kbsw_16 5x50'), update(2, '/pullup 10'), broken,
+             update(4, '/hideme on', user_id=2)]
+    api = _StubApi(results={'getUpdates': [batch, batch, []]})
+    app = _create_app_with_env(JS_DATABASE_URI='sqlite://', JS_COMMAND_LOG='off',
+                               JS_TELEGRAM_API_URL=api.url)
+    with app.app_context():
+        m.db.create_all()
+        m.Workout.create_builtin_workouts()
+    sender = OutboundSender(api.url, workers=2).start()
+    try:
+        assert TelegramPoller(app, '42:secret', sender, timeout=0).poll_once() == 4
+        # a restarted poller resumes from the stored offset, and skips the
+        # updates telegram sends again
+        poller = TelegramPoller(app, '42:secret', sender, timeout=0)
+        assert poller.poll_once() == 0
+        assert poller.poll_once() == 0
+        sender.stop()
+    finally:
+        api.close()
+
+    fetches = [payload for path, payload in api.calls if path.endswith('getUpdates')]
+    assert [f['offset'] for f in fetches] == [0, 5, 5]
+    replies = [payload for path, payload in api.calls if path.endswith('sendMessage')]
+    assert sorted(r['reply_to_message_id'] for r in replies) == [1, 2, 4]
+    with app.app_context():
+        assert m.WorkOutRecord.query.count() == 2
+        assert m.get_user('2').invisible
+        assert m.get_update_offset('telegram:42') == 5
+
+
+def test_poller_logs_commands_of_committed_updates():
+    import copy
+    import json
+    import os
+    import tempfile
+
+    from . import commands
+    from . import main
+    from .app import _create_app_with_env
+    from .outbound import _StubApi
+    from .samples import telegram_request_sample
+
+    def update(update_id, text):
+        result = copy.deepcopy(telegram_request_sample)
+        result['update_id'] = update_id
+        result['message'].update(message_id=update_id, text=text)
+        return result
+
+    def boom(cmdline):
+        raise RuntimeError('boom')
+
+    batch = [update(1, '/kbsw_16 5x50'), update(2, '/boom now'), update(3, '/pullup 10')]
+    api = _StubApi()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'commands.jsonl')
+        app = _create_app_with_env(JS_DATABASE_URI='sqlite://', JS_COMMAND_LOG='jsonl',
+                                   JS_COMMAND_LOG_PATH=path, JS_TELEGRAM_API_URL=api.url)
+        with app.app_context():
+            m.db.create_all()
+            m.Workout.create_builtin_workouts()
+        commands.dispatcher.by_name['boom'] = commands.CmdRegisterItem(boom, predicate='boom')
+        main._command_log = None
+        try:
+            replies = TelegramPoller(app, '42:secret', None).process_batch(batch)
+            main._command_log.stop()
+        finally:
+            del commands.dispatcher.by_name['boom']
+            main._command_log = None
+            api.close()
+        with open(path, encoding='utf8') as f:
+            logged = [json.loads(line)['text'] for line in f]
+    assert [r['reply_to_message_id'] for r in replies] == [1, 3]
+    assert logged == ['kbsw-16 5x50', 'pullup 10']
+    with app.app_context():
+        assert m.WorkOutRecord.query.count() == 2
+        assert m.get_update_offset('telegram:42') == 4
+
+
+if __name__ == '__main__':
+    main()
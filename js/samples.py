@@ -31,4 +31,16 @@ beary_request_sample = {
   "subdomain" : "your_domain",
   "channel_name" : "your_channel",
   "user_name" : "your_name"
-}
\ No newline at end of file
+}
+
+telegram_request_sample = {
+  "update_id": 10000,
+  "message": {
+    "message_id": 1365,
+    "date": 1441645532,
+    "from": {"id": 1111111, "is_bot": False, "first_name": "your_name"},
+    "chat": {"id": 1111111, "type": "private", "first_name": "your_name"},
+    "text": "/kbsw_16 5x50",
+    "entities": [{"type": "bot_command", "offset": 0, "length": 8}]
+  }
+}
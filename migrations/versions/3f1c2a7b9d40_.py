@@ -0,0 +1,31 @@
+"""add indexes for record and progress queries
+
+Revision ID: 3f1c2a7b9d40
+Revises: 6d8b8934df38
+Create Date: 2026-10-18 10:12:31.204518
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7b9d40'
+down_revision = '6d8b8934df38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_work_out_record_user_id_ts', 'work_out_record', ['user_id', 'ts'], unique=False)
+    op.create_index('ix_work_out_record_user_id_id', 'work_out_record', ['user_id', 'id'], unique=False)
+    op.create_index('ix_challenge_progress_user_id_challenge_id_finished', 'challenge_progress', ['user_id', 'challenge_id', 'finished'], unique=False)
+    op.create_index('ix_challenge_progress_user_id_finished', 'challenge_progress', ['user_id', 'finished'], unique=False)
+    op.create_index('ix_command_user_id_ts', 'command', ['user_id', 'ts'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_command_user_id_ts', table_name='command')
+    op.drop_index('ix_challenge_progress_user_id_finished', table_name='challenge_progress')
+    op.drop_index('ix_challenge_progress_user_id_challenge_id_finished', table_name='challenge_progress')
+    op.drop_index('ix_work_out_record_user_id_id', table_name='work_out_record')
+    op.drop_index('ix_work_out_record_user_id_ts', table_name='work_out_record')
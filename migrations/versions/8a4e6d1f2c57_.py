@@ -0,0 +1,80 @@
+"""add leaderboard entries
+
+Revision ID: 8a4e6d1f2c57
+Revises: 3f1c2a7b9d40
+Create Date: 2026-10-18 11:02:47.918230
+
+"""
+import collections
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6d1f2c57'
+down_revision = '3f1c2a7b9d40'
+branch_labels = None
+depends_on = None
+
+user = sa.table('user', sa.column('id'))
+record = sa.table('work_out_record', sa.column('user_id'), sa.column('workout_id'),
+                  sa.column('ts'), sa.column('times'))
+workout = sa.table('workout', sa.column('id'), sa.column('name'))
+
+BUCKETS = ('day', 'week', 'month', 'all')
+ALL_FAMILIES = '*'
+
+
+def _bucket_start(bucket, date):
+    if bucket == 'day':
+        return date
+    if bucket == 'week':
+        return date - datetime.timedelta(days=date.weekday())
+    if bucket == 'month':
+        return date.replace(day=1)
+    return datetime.date(1970, 1, 1)
+
+
+def upgrade():
+    entry = op.create_table('leaderboard_entry',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('bucket', sa.String(length=8), nullable=False),
+    sa.Column('bucket_start', sa.Date(), nullable=False),
+    sa.Column('family', sa.String(length=80), nullable=False),
+    sa.Column('times', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('bucket', 'bucket_start', 'family', 'user_id')
+    )
+    op.create_index('ix_leaderboard_entry_top', 'leaderboard_entry', ['bucket', 'bucket_start', 'family', 'times'], unique=False)
+
+    # fill in the entries of the existing records one user at a time, from
+    # the times of their workouts summed up by day
+    bind = op.get_bind()
+    families = {id_: name.split('-', 1)[0]
+                for id_, name in bind.execute(sa.select([workout.c.id, workout.c.name]))}
+    day = sa.func.date(record.c.ts, type_=sa.Date)
+    user_ids = [id_ for id_, in bind.execute(sa.select([user.c.id]).order_by(user.c.id))]
+    for user_id in user_ids:
+        query = sa.select([record.c.workout_id, day, sa.func.sum(record.c.times)])\
+            .where(record.c.user_id == user_id)\
+            .group_by(record.c.workout_id, day)
+        totals = collections.Counter()
+        for workout_id, date, times in bind.execute(query):
+            for bucket in BUCKETS:
+                for family in (families[workout_id], ALL_FAMILIES):
+                    totals[(bucket, _bucket_start(bucket, date), family)] += times
+        if totals:
+            op.bulk_insert(entry, [
+                {'user_id': user_id, 'bucket': bucket, 'bucket_start': start,
+                 'family': family, 'times': times}
+                for (bucket, start, family), times in totals.items()
+            ])
+
+
+def downgrade():
+    op.drop_index('ix_leaderboard_entry_top', table_name='leaderboard_entry')
+    op.drop_table('leaderboard_entry')
@@ -0,0 +1,28 @@
+"""add update offsets
+
+Revision ID: a2d6f0c8e4b1
+Revises: f4b8d2e6a915
+Create Date: 2026-10-18 21:12:05.482913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a2d6f0c8e4b1'
+down_revision = 'f4b8d2e6a915'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('update_offset',
+    sa.Column('name', sa.String(length=80), nullable=False),
+    sa.Column('next_update_id', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('update_offset')
@@ -0,0 +1,34 @@
+"""add finished challenge counter to user
+
+Revision ID: b7d93e05a6c1
+Revises: 8a4e6d1f2c57
+Create Date: 2026-10-18 11:40:05.336912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d93e05a6c1'
+down_revision = '8a4e6d1f2c57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.add_column(sa.Column('finished_challenges', sa.Integer(), server_default='0', nullable=False))
+
+    user = sa.table('user', sa.column('id'), sa.column('finished_challenges'))
+    progress = sa.table('challenge_progress', sa.column('user_id'), sa.column('finished'))
+    finished = sa.select([sa.func.count()])\
+        .where(progress.c.user_id == user.c.id)\
+        .where(progress.c.finished == sa.true())\
+        .as_scalar()
+    op.execute(user.update().values(finished_challenges=finished))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('finished_challenges')
@@ -0,0 +1,32 @@
+"""add latest record time to challenge progress
+
+Revision ID: c5e2f8a1d3b9
+Revises: b7d93e05a6c1
+Create Date: 2026-10-18 12:21:54.017743
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e2f8a1d3b9'
+down_revision = 'b7d93e05a6c1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('challenge_progress', sa.Column('latest_record_ts', sa.DateTime(), nullable=True))
+
+    progress = sa.table('challenge_progress', sa.column('latest_record_id'), sa.column('latest_record_ts'))
+    record = sa.table('work_out_record', sa.column('id'), sa.column('ts'))
+    latest_ts = sa.select([record.c.ts])\
+        .where(record.c.id == progress.c.latest_record_id)\
+        .as_scalar()
+    op.execute(progress.update().values(latest_record_ts=latest_ts))
+
+
+def downgrade():
+    with op.batch_alter_table('challenge_progress') as batch_op:
+        batch_op.drop_column('latest_record_ts')
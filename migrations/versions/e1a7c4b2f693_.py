@@ -0,0 +1,128 @@
+"""store one work out record per check-in with run length encoded sets
+
+Revision ID: e1a7c4b2f693
+Revises: c5e2f8a1d3b9
+Create Date: 2026-10-18 14:08:12.550391
+
+"""
+import collections
+import itertools
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1a7c4b2f693'
+down_revision = 'c5e2f8a1d3b9'
+branch_labels = None
+depends_on = None
+
+record = sa.table('work_out_record', sa.column('id'), sa.column('user_id'),
+                  sa.column('workout_id'), sa.column('ts'), sa.column('times'),
+                  sa.column('sets'), sa.column('tonnage'))
+progress = sa.table('challenge_progress', sa.column('id'), sa.column('latest_record_id'))
+workout = sa.table('workout', sa.column('id'), sa.column('name'))
+
+PAGE = 10000
+
+
+def _weight(name):
+    parts = name.split('-', 1)
+    if len(parts) == 2 and parts[1].isdecimal():
+        return int(parts[1])
+    return 0
+
+
+def _format_sets(times_list):
+    groups = [(times, len(list(same))) for times, same in itertools.groupby(times_list)]
+    return ','.join(f'{times}' if count == 1 else f'{times}x{count}'
+                    for times, count in groups)
+
+
+def _pages(bind):
+    """
+    the (id, user_id, workout_id, ts, times) rows of the records ordered by
+    (user_id, id), fetched in keyset paginated pages.
+    """
+    last = None
+    while True:
+        query = sa.select([record.c.id, record.c.user_id, record.c.workout_id,
+                           record.c.ts, record.c.times])\
+            .order_by(record.c.user_id, record.c.id).limit(PAGE)
+        if last is not None:
+            query = query.where(sa.or_(record.c.user_id > last[1],
+                                       sa.and_(record.c.user_id == last[1],
+                                               record.c.id > last[0])))
+        rows = [tuple(row) for row in bind.execute(query)]
+        if not rows:
+            return
+        yield rows
+        last = rows[-1]
+
+
+def _flush(bind, updates, deletes, remapped):
+    # executemany with one id per row, an IN list could exceed the variable
+    # limit of sqlite
+    if updates:
+        bind.execute(record.update()
+                     .where(record.c.id == sa.bindparam('_id'))
+                     .values(times=sa.bindparam('times'), sets=sa.bindparam('sets'),
+                             tonnage=sa.bindparam('tonnage')),
+                     updates)
+    if deletes:
+        bind.execute(record.delete().where(record.c.id == sa.bindparam('_id')), deletes)
+    if remapped:
+        bind.execute(progress.update()
+                     .where(progress.c.id == sa.bindparam('_id'))
+                     .values(latest_record_id=sa.bindparam('latest_record_id')),
+                     remapped)
+    updates.clear()
+    deletes.clear()
+    remapped.clear()
+
+
+def upgrade():
+    op.add_column('work_out_record', sa.Column('sets', sa.String(length=1024), nullable=True))
+    op.add_column('work_out_record', sa.Column('tonnage', sa.Integer(), server_default='0', nullable=False))
+
+    # the sets of a check-in share user, workout and ts, merge them into the
+    # row with the largest id, which keeps `id > start_record_id` meaningful.
+    # the records are read one user at a time, the rows of a user already
+    # read are not visited by the later pages.
+    bind = op.get_bind()
+    weights = {id_: _weight(name) for id_, name in bind.execute(sa.select([workout.c.id, workout.c.name]))}
+    latest = collections.defaultdict(list)
+    for id_, latest_record_id in bind.execute(sa.select([progress.c.id, progress.c.latest_record_id])):
+        latest[latest_record_id].append(id_)
+    rows = itertools.chain.from_iterable(_pages(bind))
+    updates, deletes, remapped = [], [], []
+    for user_id, user_rows in itertools.groupby(rows, lambda r: r[1]):
+        groups = collections.OrderedDict()
+        for id_, _, workout_id, ts, times in user_rows:
+            groups.setdefault((workout_id, ts), []).append((id_, times))
+        for (workout_id, _), group in groups.items():
+            kept_id = group[-1][0]
+            times_list = [times for _, times in group]
+            total = sum(times_list)
+            updates.append({'_id': kept_id, 'times': total, 'sets': _format_sets(times_list),
+                            'tonnage': total * weights.get(workout_id, 0)})
+            for id_, _ in group[:-1]:
+                deletes.append({'_id': id_})
+                remapped.extend({'_id': progress_id, 'latest_record_id': kept_id}
+                                for progress_id in latest.get(id_, ()))
+        if len(updates) >= PAGE or len(deletes) >= PAGE:
+            _flush(bind, updates, deletes, remapped)
+    _flush(bind, updates, deletes, remapped)
+
+    with op.batch_alter_table('work_out_record') as batch_op:
+        batch_op.alter_column('sets', existing_type=sa.String(length=1024), nullable=False)
+
+
+def downgrade():
+    # splitting the records into one row per set again gives all but one set
+    # new ids after every start_record_id and latest_record_id of the
+    # challenge progresses, which then count the old sets again
+    raise RuntimeError('the work out records cannot be split into sets again '
+                       'without breaking the challenge progresses, restore a '
+                       'backup taken before revision e1a7c4b2f693 instead')
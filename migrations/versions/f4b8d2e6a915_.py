@@ -0,0 +1,69 @@
+"""add daily rollups
+
+Revision ID: f4b8d2e6a915
+Revises: e1a7c4b2f693
+Create Date: 2026-10-18 15:31:40.127554
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4b8d2e6a915'
+down_revision = 'e1a7c4b2f693'
+branch_labels = None
+depends_on = None
+
+user = sa.table('user', sa.column('id'))
+record = sa.table('work_out_record', sa.column('id'), sa.column('user_id'),
+                  sa.column('workout_id'), sa.column('ts'), sa.column('times'),
+                  sa.column('sets'), sa.column('tonnage'))
+
+
+def _count_sets(sets):
+    # '50x2,40' -> 3
+    return sum(int(part.partition('x')[2] or 1) for part in sets.split(','))
+
+
+def upgrade():
+    rollup = op.create_table('daily_rollup',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('sets', sa.Integer(), nullable=False),
+    sa.Column('times', sa.Integer(), nullable=False),
+    sa.Column('tonnage', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('workout_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['workout_id'], ['workout.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'date', 'workout_id')
+    )
+
+    # fill in the rollups of the existing records one user at a time, from
+    # their check-ins counted by day, workout and sets
+    bind = op.get_bind()
+    day = sa.func.date(record.c.ts, type_=sa.Date)
+    user_ids = [id_ for id_, in bind.execute(sa.select([user.c.id]).order_by(user.c.id))]
+    for user_id in user_ids:
+        query = sa.select([day, record.c.workout_id, record.c.sets, sa.func.count(record.c.id),
+                           sa.func.sum(record.c.times), sa.func.sum(record.c.tonnage)])\
+            .where(record.c.user_id == user_id)\
+            .group_by(day, record.c.workout_id, record.c.sets)
+        totals = {}
+        for date, workout_id, sets, count, times, tonnage in bind.execute(query):
+            total = totals.setdefault((date, workout_id), [0, 0, 0])
+            total[0] += _count_sets(sets) * count
+            total[1] += times
+            total[2] += tonnage
+        if totals:
+            op.bulk_insert(rollup, [
+                {'user_id': user_id, 'date': date, 'workout_id': workout_id,
+                 'sets': sets, 'times': times, 'tonnage': tonnage}
+                for (date, workout_id), (sets, times, tonnage) in totals.items()
+            ])
+
+
+def downgrade():
+    op.drop_table('daily_rollup')